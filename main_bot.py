@@ -2,17 +2,29 @@ import os
 import logging
 import io
 import json
+import orjson
 import base64
 import tempfile
 import re
+import math
 import gzip
 import uuid
-from datetime import datetime, timezone
+import functools
+import hashlib
+import multiprocessing
+import posixpath
+from dataclasses import dataclass
+from types import SimpleNamespace
+from urllib.parse import urlparse
+from collections import OrderedDict
+from html import escape
+from datetime import datetime, timedelta, timezone
 from PIL import Image
 import fitz  # PyMuPDF
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+import zstandard
 import google.generativeai as genai
 import asyncio
 import random
@@ -20,9 +32,10 @@ import httpx
 import telegram
 from dotenv import load_dotenv
 from typing import Dict, Optional
-import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -36,6 +49,8 @@ from azure.core.credentials import AzureKeyCredential
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult, DocumentTable
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
+from google.api_core import exceptions as google_exceptions
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from yandex_storage import yandex_storage
 
 # --- Конфигурация ---
@@ -93,12 +108,11 @@ except Exception as _e:
 # Поддержка Railway: GCS credentials из переменной окружения
 if os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON"):
     import tempfile
-    import json
     try:
         credentials_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-        credentials = json.loads(credentials_json)
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as f:
-            json.dump(credentials, f)
+        credentials = orjson.loads(credentials_json)
+        with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.json') as f:
+            f.write(orjson.dumps(credentials))
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = f.name
         logger.info("✅ GCS credentials loaded from environment variable")
     except Exception as e:
@@ -112,31 +126,157 @@ logging.getLogger("telegram.ext._updater").setLevel(logging.WARNING)
 # Константы
 (SELECTING_ACTION, AWAITING_CONFIRMATION, AWAITING_MANUAL_PAGE, AWAITING_URL, AWAITING_FEEDBACK) = range(5)
 TEMP_DIR = "temp_bot_files"
+# Отладочные копии OCR HTML и JSON на диск (по две записи на каждый документ) — только по запросу
+SAVE_DEBUG_FILES = os.getenv("SAVE_DEBUG_FILES", "0") == "1"
 MAX_RETRIES = 3
+MAX_URL_FILE_SIZE = 50 * 1024 * 1024  # 50 MB лимит для файлов по ссылке
+MAX_TELEGRAM_FILE_SIZE = 20 * 1024 * 1024  # 20 MB — лимит Bot API на скачивание файлов
+# Поддерживаются только ссылки Dropbox: проверка простым startswith, без регулярного выражения
+DROPBOX_URL_PREFIXES = (
+    "https://www.dropbox.com/",
+    "https://dropbox.com/",
+    "https://dl.dropbox.com/",
+    "https://dl.dropboxusercontent.com/",
+)
+MAX_PDF_PAGES = 100
+OCR_RENDER_DPI = 300  # Разрешение растра для OCR и архива
+AZURE_MAX_IMAGE_SIDE = 10000  # Azure Document Intelligence принимает изображения до 10000px по стороне
+OCR_MIN_JPEG_QUALITY = 40  # Ниже этого качества JPEG-артефакты начинают мешать распознаванию
+PREVIEW_CACHE_SIZE = 64  # Сколько превью страниц держать в памяти для повторных отправок того же PDF
+SPECULATIVE_PREVIEW_MAX_PAGES = 3  # Документы до стольких страниц рендерим в превью заранее, пока ждем Gemini
 GEMINI_TIMEOUT_SECONDS = 120  # 2 минуты таймаут для Gemini API
+# Временные ошибки Gemini/Vertex, после которых имеет смысл повторить запрос
+GEMINI_RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    httpx.HTTPError,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.DeadlineExceeded,
+)
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = 5  # После стольких подряд неудачных вызовов (с учетом повторов) Gemini считается недоступным
+GEMINI_CIRCUIT_OPEN_SECONDS = 60  # Сколько после этого отклонять вызовы сразу, не дожидаясь таймаутов
 FEEDBACK_TIMEOUT_SECONDS = 1800  # 30 минут для продакшена
+PROCESSING_IN_PROGRESS_MESSAGE = "⏳ Документ еще обрабатывается, пожалуйста, подождите. Для отмены отправьте /cancel."
+STATUS_UPDATE_DELAYS = (60, 60)  # Паузы перед первыми сообщениями о статусе: через минуту и через две
+STATUS_UPDATE_REPEAT_SECONDS = 30  # Дальше сообщения о статусе идут с этим интервалом
+# Тексты feedback.txt по статусу обратной связи ({time} — время события)
+FEEDBACK_MESSAGES = {
+    "good": "Пользователь доволен результатом обработки\nВремя обратной связи: {time}",
+    "bad": "Пользователь НЕ доволен результатом обработки\nВремя обратной связи: {time}\nКонтакт админа: @aianback",
+    "timeout": "Пользователь не предоставил обратную связь (timeout)\nВремя истечения: {time}",
+}
+SHUTDOWN_BACKGROUND_TIMEOUT_SECONDS = 30  # Сколько при остановке ждать фоновые задачи (финализация, архив)
+DATASET_COMPACTION_INTERVAL_SECONDS = 6 * 3600  # Как часто склеивать part-файлы прошедших дней
+PROMPT_CACHE_TTL = timedelta(hours=1)  # Время жизни кэша промпта extract_and_correct на стороне Gemini
+PROMPT_CACHE_RETRY_SECONDS = 600  # Пауза перед повторной попыткой, если кэш создать не удалось
+OCR_HTML_FILE = "ocr_raw.html.zst"  # Имя архивного HTML от Azure OCR внутри base_path
+SPEC_CACHE_PREFIX = "cache"  # Префикс в бакете для готовых результатов OCR + Gemini по хэшу PDF
+GEMINI_FILE_TTL_SECONDS = 48 * 3600  # Сколько Files API хранит загруженный файл, если expiration_time не пришел
+GEMINI_FILE_REUSE_MARGIN_SECONDS = 300  # Не переиспользуем файл, который вот-вот истечет
+GEMINI_FILE_SWEEP_INTERVAL_SECONDS = 3600  # Как часто удалять истекшие файлы из кэша загрузок
+GEMINI_FILE_CACHE_SIZE = 32  # Сколько загруженных PDF держать в Files API; вытесненные удаляются
+FALLBACK_PROFILE_NAME = "Исходные данные OCR"  # Профиль-заглушка из последней fallback стратегии
+PLAIN_TEXT_PROMPT_LIMIT = 3000  # Сколько символов текста OCR отдавать в упрощенный промпт (стратегия 3)
+
+# Регулярные выражения компилируются один раз при импорте
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+NUMBER_RE = re.compile(r'\d+[,.]?\d*')
+FILENAME_DISALLOWED_RE = re.compile(r'[^a-zA-Zа-яёА-ЯЁ0-9_]')
+CODE_FENCE_OPEN_RE = re.compile(r"^```[a-zA-Z0-9_+-]*\s*")
+CODE_FENCE_CLOSE_RE = re.compile(r"\n?```\s*$")
+GDRIVE_FILE_ID_RE = re.compile(r'/d/([a-zA-Z0-9-_]+)')
+# Узел дерева страниц без вложенных словарей (обычно корневой /Pages): << ... /Type /Pages ... /Count N ... >>
+PDF_PAGES_NODE_RE = re.compile(rb"<<[^<>]*?/Type\s*/Pages\b[^<>]*>>")
+PDF_COUNT_RE = re.compile(rb"/Count\s+(\d+)")
+
+# Схема записи parquet датасета (одна строка на обработанный документ)
+PARQUET_RECORD_SCHEMA = pa.schema([
+    ("timestamp", pa.string()),
+    ("user_id", pa.int64()),
+    ("pdf_name", pa.string()),
+    ("processing_id", pa.string()),
+    ("feedback_status", pa.string()),
+    ("profiles_found", pa.int64()),
+    ("total_mass_tons", pa.float64()),
+    ("unique_profile_types", pa.int64()),
+    ("find_prompt_length", pa.int64()),
+    ("extract_prompt_length", pa.int64()),
+    ("yandex_path", pa.string()),
+    ("image_uri", pa.string()),
+    ("ocr_html_uri", pa.string()),
+    ("corrected_uri", pa.string()),
+])
+
+# Настройки безопасности (если поддерживаются провайдером)
+GEMINI_SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+# Кэш контекста Gemini для промпта extract_and_correct (см. get_cached_prompt_model)
+# pending — задача создания кэша (одна на все параллельные вызовы), unsupported — промпт, для которого кэш невозможен
+prompt_cache: Dict[str, object] = {"prompt": None, "model": None, "expires_at": 0.0, "retry_at": 0.0, "pending": None, "unsupported": None}
+# Circuit breaker для Gemini (см. run_gemini_with_retry): счетчик неудач подряд и время, до которого вызовы отклоняются
+gemini_circuit: Dict[str, float] = {"failures": 0, "open_until": 0.0}
+# Ограничение одновременных вызовов Gemini (общий пул соединений SDK не резиновый)
+gemini_semaphore = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")))
+# Ограничение одновременных анализов Azure OCR (квота запросов в секунду и память на изображения)
+azure_semaphore = asyncio.Semaphore(int(os.getenv("AZURE_MAX_CONCURRENCY", "4")))
+
+
+@dataclass(slots=True)
+class PendingFeedback:
+    """Отложенная финализация записи, ожидающая обратной связи пользователя."""
+    base_path: str
+    handle: asyncio.TimerHandle
+    started_at: datetime
+    corrected_data: Optional[dict] = None
+
 
 # Глобальное хранилище отложенных задач
-pending_feedback_tasks: Dict[int, Dict] = {}
+pending_feedback_tasks: Dict[int, PendingFeedback] = {}
+# LRU-кэш готовых превью: (sha256 PDF, номер страницы) -> байты изображения
+preview_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+# LRU-кэш загрузок в Gemini Files API (только файлы в состоянии ACTIVE): sha256 PDF -> (имя файла, время истечения)
+gemini_file_cache: "OrderedDict[str, tuple]" = OrderedDict()
+# Ссылки на фоновые задачи (asyncio хранит только слабые ссылки)
+background_tasks: set = set()
+# Пул потоков для блокирующих вызовов boto3 (клиент потокобезопасен)
+storage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="yandex-storage")
+# Выбор пула для CPU-работы: Pillow отпускает GIL при кодировании, а PyMuPDF (рендер) и openpyxl
+# (чистый Python) — нет, и в потоке они все равно тормозят event loop. Поэтому в потоках остается
+# только короткая работа (открытие PDF, превью 1280px), а тяжелый рендер и отчеты — в процессах.
+# Пул потоков для коротких CPU-задач с изображениями и PDF
+cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="cpu")
+# Рабочие процессы запускаются через forkserver, а не fork: fork процесса, в котором уже работают
+# пулы потоков, HTTP-клиенты и event loop, может унаследовать захваченные блокировки и зависнуть
+process_pool_context = multiprocessing.get_context("forkserver")
+# Пул процессов для генерации отчетов (openpyxl/pandas)
+report_executor = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 4), mp_context=process_pool_context)
+# Пул процессов для растеризации страниц 300 DPI (OCR и архив)
+render_executor = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 4), mp_context=process_pool_context)
+# Общий HTTP-клиент для скачивания PDF: keep-alive соединения переиспользуются между запросами
+http_client = httpx.AsyncClient(
+    timeout=300.0,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
 
 # --- Функции-помощники ---
 
+@functools.lru_cache(maxsize=8)
 def create_gemini_model(model_name: str = None):
     """Создает модель Gemini. При USE_VERTEX_AI=1 используется Vertex AI SDK.
 
-    Промпты и название модели не меняются.
+    Промпты и название модели не меняются. Экземпляр кэшируется на процесс (создается в main()
+    при старте), поэтому запросы не пересоздают модель и не вызывают vertexai.init повторно.
     """
     if model_name is None:
         model_name = GEMINI_MODEL_NAME
 
-    # Настройки безопасности (если поддерживаются провайдером)
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    }
-
     if USE_VERTEX_AI:
         try:
             import vertexai
@@ -154,34 +294,35 @@ def create_gemini_model(model_name: str = None):
                     # Для логов используем формат, аналогичный Google SDK
                     self.model_name = f"models/{name}"
 
+                @staticmethod
+                def _to_vertex_config(generation_config):
+                    # Конвертируем Google AI GenerationConfig в Vertex AI формат
+                    if generation_config is None or not hasattr(generation_config, 'response_mime_type'):
+                        # Если это уже словарь (или конфигурации нет), используем как есть
+                        return generation_config
+                    # Vertex также поддерживает response_mime_type, max_output_tokens и др.
+                    vertex_config = {}
+                    if generation_config.response_mime_type:
+                        vertex_config['response_mime_type'] = generation_config.response_mime_type
+                    if getattr(generation_config, 'max_output_tokens', None):
+                        vertex_config['max_output_tokens'] = generation_config.max_output_tokens
+                    if getattr(generation_config, 'temperature', None) is not None:
+                        vertex_config['temperature'] = generation_config.temperature
+                    return vertex_config
+
                 async def generate_content_async(self, parts, generation_config=None):
-                    # Синхронный вызов Vertex оборачиваем в поток
-                    def call():
-                        # Пытаемся аккуратно пробросить generation_config, если он содержит совместимые поля
-                        try:
-                            # Vertex также поддерживает response_mime_type, max_output_tokens и др.
-                            if generation_config is not None:
-                                # Конвертируем Google AI GenerationConfig в Vertex AI формат
-                                if hasattr(generation_config, 'response_mime_type'):
-                                    # Создаем словарь для Vertex AI
-                                    vertex_config = {}
-                                    if generation_config.response_mime_type:
-                                        vertex_config['response_mime_type'] = generation_config.response_mime_type
-                                    if hasattr(generation_config, 'max_output_tokens') and generation_config.max_output_tokens:
-                                        vertex_config['max_output_tokens'] = generation_config.max_output_tokens
-                                    if hasattr(generation_config, 'temperature') and generation_config.temperature is not None:
-                                        vertex_config['temperature'] = generation_config.temperature
-                                    
-                                    return self._inner.generate_content(parts, generation_config=vertex_config)
-                                else:
-                                    # Если это уже словарь, используем как есть
-                                    return self._inner.generate_content(parts, generation_config=generation_config)
-                            return self._inner.generate_content(parts)
-                        except (TypeError, AttributeError):
-                            # Если тип конфигурации не совпал — вызываем без нее
-                            return self._inner.generate_content(parts)
-
-                    return await asyncio.to_thread(call)
+                    # Нативный асинхронный вызов Vertex SDK — без отдельного потока на каждый запрос
+                    try:
+                        vertex_config = self._to_vertex_config(generation_config)
+                    except AttributeError:
+                        vertex_config = None
+                    if vertex_config is None:
+                        return await self._inner.generate_content_async(parts)
+                    try:
+                        return await self._inner.generate_content_async(parts, generation_config=vertex_config)
+                    except TypeError:
+                        # Если тип конфигурации не совпал — вызываем без нее
+                        return await self._inner.generate_content_async(parts)
 
             return VertexModelWrapper(v_model, model_name)
         except Exception as e:
@@ -191,40 +332,92 @@ def create_gemini_model(model_name: str = None):
     # Обычный Gemini API
     return genai.GenerativeModel(
         model_name=model_name,
-        safety_settings=safety_settings
+        safety_settings=GEMINI_SAFETY_SETTINGS
     )
 
-async def wait_for_gemini_file_active(gemini_file, user_id: int, timeout_seconds: int = 180, poll_interval: float = 1.5):
+@functools.lru_cache(maxsize=1)
+def get_azure_client() -> DocumentIntelligenceClient:
+    """
+    Общий клиент Azure Document Intelligence: асинхронный клиент безопасен для параллельных запросов
+    и держит пул соединений, поэтому TLS-рукопожатие не повторяется на каждый документ.
+    Закрывается в on_shutdown.
+    """
+    return DocumentIntelligenceClient(endpoint=AZURE_ENDPOINT, credential=AzureKeyCredential(AZURE_KEY))
+
+async def _create_prompt_cache(prompt: str):
+    """Создает CachedContent для промпта и обновляет prompt_cache. Возвращает модель или None."""
+    now = time.monotonic()
+    try:
+        cached = await asyncio.to_thread(
+            genai.caching.CachedContent.create,
+            model=GEMINI_MODEL_NAME,
+            display_name="extract_and_correct",
+            contents=[prompt],
+            ttl=PROMPT_CACHE_TTL,
+        )
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached, safety_settings=GEMINI_SAFETY_SETTINGS)
+    except (google_exceptions.InvalidArgument, google_exceptions.NotFound, google_exceptions.FailedPrecondition) as e:
+        # Модель не поддерживает кэш или промпт короче минимального размера — повтор ничего не изменит
+        logger.warning(f"Gemini prompt cache not supported for this model/prompt, sending full prompt: {e}")
+        prompt_cache.update(prompt=prompt, model=None, expires_at=0.0, unsupported=prompt)
+        return None
+    except Exception as e:
+        logger.warning(f"Gemini prompt cache unavailable, sending full prompt: {e}")
+        prompt_cache.update(prompt=prompt, model=None, expires_at=0.0, retry_at=now + PROMPT_CACHE_RETRY_SECONDS)
+        return None
+    
+    # Обновляем чуть раньше истечения TTL, чтобы не ссылаться на уже удаленный кэш
+    expires_at = now + PROMPT_CACHE_TTL.total_seconds() - 60
+    prompt_cache.update(prompt=prompt, model=model, expires_at=expires_at, retry_at=0.0)
+    logger.info(f"Gemini prompt cache created: {cached.name}")
+    return model
+
+async def get_cached_prompt_model(prompt: str):
+    """
+    Возвращает модель, у которой статичный промпт уже лежит в кэше контекста Gemini (CachedContent),
+    чтобы в запросе отправлять только HTML. Кэш пересоздается по истечении TTL или при изменении
+    промпта. Возвращает None, если кэш недоступен (Vertex AI, слишком короткий промпт, неподдерживаемая
+    модель) — тогда вызывающий код отправляет промпт целиком, как раньше.
+    Создание кэша — один сетевой вызов на все параллельные запросы: его ждет только тот, кто его начал,
+    остальные сразу отправляют промпт целиком.
+    """
+    # Неверсионированные алиасы (*-latest) CachedContent не принимает
+    if USE_VERTEX_AI or not prompt or GEMINI_MODEL_NAME.endswith("-latest") or prompt_cache["unsupported"] == prompt:
+        return None
+    
+    now = time.monotonic()
+    if prompt_cache["prompt"] == prompt and now < prompt_cache["expires_at"]:
+        return prompt_cache["model"]
+    if prompt_cache["prompt"] == prompt and now < prompt_cache["retry_at"]:
+        return None
+    if prompt_cache["pending"] is not None:
+        return None
+    
+    pending = asyncio.ensure_future(_create_prompt_cache(prompt))
+    prompt_cache["pending"] = pending
+    pending.add_done_callback(lambda _: prompt_cache.update(pending=None))
+    # shield: отмена вызывающего не прерывает создание кэша, которым воспользуются следующие запросы
+    return await asyncio.shield(pending)
+
+async def wait_for_gemini_file_active(gemini_file, user_id: int, timeout_seconds: int = 180, poll_interval: float = 1.0, max_poll_interval: float = 8.0):
     """Ожидает, пока загруженный файл Gemini перейдет в состояние ACTIVE.
 
     Без этой паузы вызов generate_content может падать 500, пока файл еще обрабатывается.
+    Опрос с экспоненциально растущей паузой (x1.5, до max_poll_interval) и небольшим случайным разбросом.
     """
-    start_ts = time.time()
+    start_ts = time.monotonic()
     last_state = None
+    delay = poll_interval
     try:
         while True:
-            f = genai.get_file(gemini_file.name)
+            f = await asyncio.to_thread(genai.get_file, gemini_file.name)
             state = getattr(f, "state", None)
-            # Поддержка разных типов state: str, enum, int
-            state_name = None
-            if hasattr(state, "name"):
-                state_name = state.name
-            elif isinstance(state, str):
-                state_name = state
             
             # Подробный лог состояния
             if state != last_state:
-                logger.info(f"[USER_ID: {user_id}] - Gemini file state: {state} (type={type(state).__name__}, name={state_name})")
+                logger.info(f"[USER_ID: {user_id}] - Gemini file state: {state} (type={type(state).__name__})")
                 last_state = state
 
-            # Проверяем ACTIVE/FAILED по строке имени
-            if state_name:
-                up = str(state_name).upper()
-                if "ACTIVE" in up:
-                    return f
-                if "FAILED" in up:
-                    raise RuntimeError("Gemini file processing failed")
-
             # Если пришло числовое значение — маппим по стандартной схеме: 0=UNSPECIFIED,1=PROCESSING,2=ACTIVE,3=FAILED
             if isinstance(state, int):
                 if state == 2:
@@ -232,21 +425,44 @@ async def wait_for_gemini_file_active(gemini_file, user_id: int, timeout_seconds
                 if state == 3:
                     raise RuntimeError("Gemini file processing failed")
                 # 0/1 — еще не готов
-            if time.time() - start_ts > timeout_seconds:
+            else:
+                # Поддержка разных типов state: enum (по имени) или str
+                state_name = state.name if hasattr(state, "name") else state if isinstance(state, str) else None
+                # Проверяем ACTIVE/FAILED по строке имени
+                if state_name:
+                    up = str(state_name).upper()
+                    if "ACTIVE" in up:
+                        return f
+                    if "FAILED" in up:
+                        raise RuntimeError("Gemini file processing failed")
+            
+            if time.monotonic() - start_ts > timeout_seconds:
                 raise TimeoutError("Timed out waiting for Gemini file to become ACTIVE")
-            await asyncio.sleep(poll_interval)
+            await asyncio.sleep(delay + random.uniform(0, 0.3))
+            delay = min(delay * 1.5, max_poll_interval)
     except Exception as e:
         logger.error(f"[USER_ID: {user_id}] - Error while waiting for Gemini file ACTIVE: {e}")
         raise
 
+@functools.lru_cache(maxsize=32)
+def _read_prompt(file_path: str, mtime_ns: int) -> str:
+    # mtime входит в ключ кэша: отредактированный файл перечитывается, старая версия вытесняется
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
 def get_prompt(file_path: str) -> str:
+    """Читает промпт из файла. Содержимое кэшируется и перечитывается только при изменении файла."""
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return f.read()
+        return _read_prompt(file_path, os.stat(file_path).st_mtime_ns)
     except FileNotFoundError:
         logger.error(f"Prompt file not found: {file_path}")
         return ""
 
+@functools.lru_cache(maxsize=8)
+def prompt_bytes(prompt: str) -> bytes:
+    """UTF-8 байты промпта: промпты архивируются с каждой записью, кодируем их один раз на версию."""
+    return prompt.encode("utf-8")
+
 def create_ocr_correction_prompt(ocr_text: str) -> str:
     """
     Создает промпт для коррекции OCR ошибок, используя логику из 2b_ocr_correction.py.
@@ -299,64 +515,109 @@ def create_ocr_correction_prompt(ocr_text: str) -> str:
 """
     return prompt
 
-def table_to_html(table: DocumentTable) -> str:
-    """Преобразует объект таблицы из Azure в HTML-строку, используя простую сеточную логику."""
+def table_to_html(table: DocumentTable, text_lines: Optional[list] = None) -> str:
+    """Преобразует объект таблицы из Azure в HTML-строку, используя простую сеточную логику.
+
+    Если передан text_lines, в тот же проход туда складываются непустые строки текста ячеек
+    (без HTML) — их использует fallback в run_gemini_with_fallback вместо повторного разбора HTML.
+    """
     if not table.cells:
         return ""
     
-    # Создаем сетку таблицы
-    grid = [['' for _ in range(table.column_count)] for _ in range(table.row_count)]
+    row_count, column_count = table.row_count, table.column_count
     
-    # Заполняем сетку содержимым ячеек
+    # Один проход по ячейкам: только заполненные ячейки, сразу экранированные, без полной сетки R×C
+    rows: Dict[int, Dict[int, str]] = {}
     for cell in table.cells:
         # Проверяем, что индексы не выходят за пределы сетки
-        if cell.row_index < table.row_count and cell.column_index < table.column_count:
-            grid[cell.row_index][cell.column_index] = cell.content or ''
-
-    # Генерируем HTML
+        if cell.row_index < row_count and cell.column_index < column_count:
+            content = cell.content or ''
+            rows.setdefault(cell.row_index, {})[cell.column_index] = escape(content)
+            if text_lines is not None and content:
+                text_lines.extend(line.strip() for line in content.splitlines() if line.strip())
+
+    # Генерируем HTML (пустые ячейки — пустые <td>)
+    empty_row = {}
     html_parts = ['<table border="1">']
-    for row in grid:
+    for row_index in range(row_count):
+        row = rows.get(row_index, empty_row)
         html_parts.append('<tr>')
-        for cell_content in row:
-            # Экранируем HTML-сущности
-            import html
-            html_parts.append(f'<td>{html.escape(cell_content)}</td>')
+        html_parts.extend([f'<td>{row.get(column_index, "")}</td>' for column_index in range(column_count)])
         html_parts.append('</tr>')
     html_parts.append('</table>')
     
     return '\n'.join(html_parts)
 
+def iter_spec_elements(data: dict):
+    """Обходит все элементы спецификации: профили → марки стали → размеры → элементы."""
+    for profile_data in (data.get("профили") or {}).values():
+        if not isinstance(profile_data, dict):
+            continue
+        for steel_data in (profile_data.get("марки_стали") or {}).values():
+            if not isinstance(steel_data, dict):
+                continue
+            for size_data in (steel_data.get("размеры") or {}).values():
+                if isinstance(size_data, dict):
+                    yield from size_data.get("элементы") or ()
+
+def iter_spec_masses(data: dict):
+    """Массы всех элементов спецификации, приводимые к числу (нечисловые значения пропускаются)."""
+    for element in iter_spec_elements(data):
+        if isinstance(element, dict):
+            try:
+                yield float(element.get("масса"))
+            except (ValueError, TypeError):
+                pass
+
 def flatten_json_to_dataframe(data: dict) -> pd.DataFrame:
-    flat_list = []
+    # Собираем сразу колонки (по списку на столбец), без словаря на каждую строку
+    profiles, steels, sizes, types, positions, masses = [], [], [], [], [], []
     unit = data.get("единица_измерения", "не указана")
     for profile, p_data in data.get("профили", {}).items():
         for steel, s_data in p_data.get("марки_стали", {}).items():
             for size, z_data in s_data.get("размеры", {}).items():
                 # Изменено: теперь перебираем список, а не словарь, чтобы избежать агрегации
                 for e_data in z_data.get("элементы", []):
-                    flat_list.append({
-                        "Наименование профиля": profile,
-                        "Марка стали": steel,
-                        "Размер профиля": size,
-                        "Тип элемента": e_data.get("тип"), # Данные из словаря в списке
-                        "Позиции": ", ".join(map(str, e_data.get("позиции", []))),
-                        f"Масса, {unit}": e_data.get("масса"),
-                    })
-    return pd.DataFrame(flat_list)
-
-async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dict:
-    """Запускает Gemini с fallback стратегией при блокировках"""
+                    profiles.append(profile)
+                    steels.append(steel)
+                    sizes.append(size)
+                    types.append(e_data.get("тип")) # Данные из словаря в списке
+                    positions.append(", ".join(map(str, e_data.get("позиции", []))))
+                    masses.append(e_data.get("масса"))
+    return pd.DataFrame({
+        "Наименование профиля": pd.Series(profiles, dtype=object),
+        "Марка стали": pd.Series(steels, dtype=object),
+        "Размер профиля": pd.Series(sizes, dtype=object),
+        "Тип элемента": pd.Series(types, dtype=object),
+        "Позиции": pd.Series(positions, dtype=object),
+        f"Масса, {unit}": masses,
+    })
+
+def render_reports(df: pd.DataFrame) -> tuple:
+    """Строит текстовый и Excel отчеты. Выполняется в report_executor, поэтому возвращает bytes."""
+    txt_bytes = df.to_string(index=False).encode('utf-8')
+    xlsx_buffer = io.BytesIO()
+    df.to_excel(xlsx_buffer, index=False, engine='openpyxl')
+    return txt_bytes, xlsx_buffer.getvalue()
+
+async def run_gemini_with_fallback(html_content: str, user_id: int, chat, text_lines: Optional[list] = None) -> dict:
+    """Запускает Gemini с fallback стратегией при блокировках.
+
+    text_lines — строки текста ячеек, собранные table_to_html; если не переданы, выделяются из HTML.
+    """
     logger.info(f"[USER_ID: {user_id}] - Starting Gemini processing with fallback strategy")
     
     # Стратегия 1: Полный контент с отключенными фильтрами
     try:
         logger.info(f"[USER_ID: {user_id}] - Fallback Strategy 1: Full content with disabled safety")
         prompt = get_prompt("extract_and_correct.txt")
-        model = create_gemini_model()
+        # Если промпт лежит в кэше Gemini, отправляем только HTML
+        cached_model = await get_cached_prompt_model(prompt)
+        model = cached_model or create_gemini_model()
         
         response = await run_gemini_with_retry(
             model, 
-            prompt, 
+            None if cached_model else prompt, 
             html_content, 
             user_id, 
             generation_config=GenerationConfig(response_mime_type="application/json")
@@ -381,15 +642,25 @@ async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dic
                 logger.info(f"[USER_ID: {user_id}] - Fallback Strategy 3: Plain text only")
                 
                 # Убираем HTML теги, оставляем только текст
-                import re
-                plain_text = re.sub(r'<[^>]+>', ' ', html_content)
-                plain_text = re.sub(r'\s+', ' ', plain_text).strip()
+                # В промпт идут только первые PLAIN_TEXT_PROMPT_LIMIT символов — пробелы нормализуем
+                # str.split без регулярок и только в тех строках, что туда попадут
+                if text_lines is not None:
+                    head_lines, head_size = [], 0
+                    for line in text_lines:
+                        line = ' '.join(line.split())
+                        head_lines.append(line)
+                        head_size += len(line) + 1
+                        if head_size > PLAIN_TEXT_PROMPT_LIMIT:
+                            break
+                    plain_text = ' '.join(head_lines)
+                else:
+                    plain_text = ' '.join(HTML_TAG_RE.sub(' ', html_content).split())
                 
                 # Укороченный промпт для текста
                 simple_prompt = f"""Извлеки из текста спецификации металлопроката данные в JSON формате:
 
 ТЕКСТ:
-{plain_text[:3000]}...
+{plain_text[:PLAIN_TEXT_PROMPT_LIMIT]}...
 
 ФОРМАТ ОТВЕТА (JSON):
 {{
@@ -414,7 +685,7 @@ async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dic
 Извлеки максимум данных из доступного текста."""
 
                 response = await run_gemini_with_retry(
-                    model, 
+                    create_gemini_model(), 
                     simple_prompt, 
                     "", 
                     user_id, 
@@ -434,17 +705,26 @@ async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dic
             await chat.send_message("🔄 **Создаю отчет с исходными данными OCR**\n\n📄 **В отчете будут:**\n• Исходный текст из Azure OCR\n• Структура для ручной обработки\n• Все распознанные данные")
             
             # Извлекаем данные из HTML для создания осмысленного отчета
-            import re
-            plain_text = re.sub(r'<[^>]+>', '\n', html_content)
-            lines = [line.strip() for line in plain_text.split('\n') if line.strip()]
+            if text_lines is not None:
+                lines = text_lines
+                plain_text = '\n'.join(lines)
+            else:
+                plain_text = HTML_TAG_RE.sub('\n', html_content)
+                lines = [line.strip() for line in plain_text.split('\n') if line.strip()]
             
             # Пытаемся найти хотя бы числовые данные
-            numbers = re.findall(r'\d+[,.]?\d*', plain_text)
+            numbers = NUMBER_RE.findall(plain_text)
+            total_mass = 0.0
+            for number in numbers[:10]:
+                try:
+                    total_mass += float(number.replace(',', '.'))
+                except ValueError:
+                    pass
             
             fallback_data = {
                 "единица_измерения": "т",
                 "профили": {
-                    "Исходные данные OCR": {
+                    FALLBACK_PROFILE_NAME: {
                         "марки_стали": {
                             "Требует проверки": {
                                 "размеры": {
@@ -452,7 +732,7 @@ async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dic
                                         "элементы": [{
                                             "тип": f"OCR данные ({len(lines)} строк, {len(numbers)} чисел)",
                                             "позиции": ["Весь документ"],
-                                            "масса": sum([float(n.replace(',', '.')) for n in numbers[:10] if n.replace(',', '.').replace('.', '').isdigit()]) if numbers else 0.0
+                                            "масса": total_mass
                                         }]
                                     }
                                 }
@@ -466,125 +746,207 @@ async def run_gemini_with_fallback(html_content: str, user_id: int, chat) -> dic
             return fallback_data
 
 async def run_gemini_with_retry(model, prompt, content, user_id, generation_config=None):
-    """Запускает Gemini с retry логикой. content может быть файлом или текстом"""
-    retries = 0
-    last_exception = None
+    """Запускает Gemini с retry логикой. content может быть файлом или текстом.
+    prompt=None — промпт уже в кэше контекста модели, отправляется только content"""
+    model_name = getattr(model, "model_name", "?")
+    content_type = type(content).__name__
+    prompt_length = len(prompt) if isinstance(prompt, str) else "cached" if prompt is None else "?"
+    parts = [content] if prompt is None else [prompt, content]
     
-    logger.info(f"[USER_ID: {user_id}] - Starting Gemini API call")
+    def log_retry(retry_state):
+        logger.warning(
+            f"[USER_ID: {user_id}] - 🔄 Retrying in {retry_state.next_action.sleep:.1f}s... "
+            f"(attempt {retry_state.attempt_number + 1}/{MAX_RETRIES})"
+        )
     
-    while retries < MAX_RETRIES:
-        try:
-            logger.info(f"[USER_ID: {user_id}] - Gemini API call attempt {retries + 1}/{MAX_RETRIES}")
-            
-            if generation_config:
-                response = await asyncio.wait_for(
-                    model.generate_content_async([prompt, content], generation_config=generation_config),
-                    timeout=GEMINI_TIMEOUT_SECONDS
-                )
-            else:
-                response = await asyncio.wait_for(
-                    model.generate_content_async([prompt, content]),
-                    timeout=GEMINI_TIMEOUT_SECONDS
-                )
-            
-            logger.info(f"[USER_ID: {user_id}] - ✅ Gemini API call successful")
-            return response
-            
-        except Exception as e:
-            last_exception = e
-            logger.error(f"[USER_ID: {user_id}] - ❌ Gemini API call failed: {str(e)}")
-            
-            # Проверяем на временные ошибки
-            if ("500" in str(e) or "internal error" in str(e).lower() or 
-                isinstance(e, asyncio.TimeoutError)) and retries < MAX_RETRIES - 1:
-                retries += 1
-                wait_time = 5 * (2 ** (retries - 1))
-                logger.warning(f"[USER_ID: {user_id}] - 🔄 Retrying in {wait_time}s... (attempt {retries + 1}/{MAX_RETRIES})")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error(f"[USER_ID: {user_id}] - 🚫 Non-retryable error or max retries reached")
-                raise e
+    # Circuit breaker: пока Gemini недоступен, не тратим минуты на таймауты и повторы для каждого пользователя
+    if time.monotonic() < gemini_circuit["open_until"]:
+        logger.warning(f"[USER_ID: {user_id}] - 🚫 Gemini circuit breaker is open, skipping call")
+        raise google_exceptions.ServiceUnavailable("Gemini circuit breaker is open")
     
-    logger.error(f"[USER_ID: {user_id}] - 💥 All {MAX_RETRIES} retry attempts failed")
-    raise last_exception
-
-async def send_periodic_status_updates(update, user_id, operation_name):
-    """Отправляет периодические обновления статуса во время длительных операций"""
     try:
-        await asyncio.sleep(60)  # Первое обновление через минуту
-        await update.message.reply_text(f"⏳ {operation_name.capitalize()} продолжается... Пожалуйста, подождите еще немного.")
-        
-        await asyncio.sleep(60)  # Второе обновление через 2 минуты
-        await update.message.reply_text(f"🔄 {operation_name.capitalize()} все еще выполняется... Большие документы требуют больше времени.")
-        
-        # Если дошли сюда, значит операция длится более 2 минут - это уже долго
-        while True:
-            await asyncio.sleep(30)  # Дальше каждые 30 секунд
-            await update.message.reply_text(f"⌛ {operation_name.capitalize()} в процессе...")
-    except asyncio.CancelledError:
-        # Задача была отменена, операция завершилась
-        pass
+        # Экспоненциальная пауза (5с, 10с, ... до 60с) плюс случайный разброс до 2с, чтобы повторы
+        # разных пользователей не били в API одновременно
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(GEMINI_RETRYABLE_ERRORS),
+            wait=wait_exponential_jitter(initial=5, max=60, jitter=2),
+            stop=stop_after_attempt(MAX_RETRIES),
+            before_sleep=log_retry,
+            reraise=True,
+        ):
+            with attempt:
+                # Одна запись на попытку; %-форматирование не рендерит аргументы при выключенном INFO
+                logger.info(
+                    "[USER_ID: %s] - Gemini API call attempt %d/%d: model=%s content_type=%s prompt_len=%s",
+                    user_id, attempt.retry_state.attempt_number, MAX_RETRIES, model_name, content_type, prompt_length
+                )
+                attempt_start = time.perf_counter()
+                try:
+                    # Ограничиваем число одновременных запросов к Gemini на процесс; ожидание слота
+                    # не входит в таймаут самого запроса
+                    async with gemini_semaphore:
+                        if generation_config:
+                            response = await asyncio.wait_for(
+                                model.generate_content_async(parts, generation_config=generation_config),
+                                timeout=GEMINI_TIMEOUT_SECONDS
+                            )
+                        else:
+                            response = await asyncio.wait_for(
+                                model.generate_content_async(parts),
+                                timeout=GEMINI_TIMEOUT_SECONDS
+                            )
+                except Exception as e:
+                    logger.error(f"[USER_ID: {user_id}] - ❌ Gemini API call failed after {time.perf_counter() - attempt_start:.1f}s: {str(e)}")
+                    raise
+                
+                logger.info(f"[USER_ID: {user_id}] - ✅ Gemini API call successful ({time.perf_counter() - attempt_start:.1f}s)")
+                gemini_circuit["failures"] = 0
+                return response
     except Exception as e:
-        logger.error(f"[USER_ID: {user_id}] - Error in status updates: {e}")
+        logger.error(f"[USER_ID: {user_id}] - 🚫 Non-retryable error or max retries reached")
+        # Считаются только сбои сервиса; блокировки контента и ошибки запроса на доступность не указывают
+        if isinstance(e, GEMINI_RETRYABLE_ERRORS):
+            gemini_circuit["failures"] += 1
+            if gemini_circuit["failures"] >= GEMINI_CIRCUIT_FAILURE_THRESHOLD:
+                gemini_circuit["open_until"] = time.monotonic() + GEMINI_CIRCUIT_OPEN_SECONDS
+                # После паузы одной неудачи достаточно, чтобы снова разомкнуть цепь
+                gemini_circuit["failures"] = GEMINI_CIRCUIT_FAILURE_THRESHOLD - 1
+                logger.error(f"Gemini circuit breaker opened for {GEMINI_CIRCUIT_OPEN_SECONDS}s")
+        raise
+
+
+class StatusUpdates:
+    """
+    Периодические обновления статуса во время длительной операции, остановка — cancel().
+    Работают на самоперепланирующемся таймере loop.call_later — без отдельной задачи на каждый документ.
+    Отправка сообщения уходит в фон; cancel() снимает таймер и отменяет еще не ушедшую отправку,
+    чтобы сообщение о статусе не пришло после результата.
+    """
+    __slots__ = ("update", "user_id", "operation_name", "ticks", "handle", "send_task")
+
+    def __init__(self, update, user_id, operation_name):
+        self.update = update
+        self.user_id = user_id
+        self.operation_name = operation_name.capitalize()
+        self.ticks = 0
+        self.send_task = None
+        self.handle = asyncio.get_running_loop().call_later(STATUS_UPDATE_DELAYS[0], self._tick)
+
+    def _tick(self):
+        if self.ticks == 0:
+            text = f"⏳ {self.operation_name} продолжается... Пожалуйста, подождите еще немного."
+        elif self.ticks == 1:
+            text = f"🔄 {self.operation_name} все еще выполняется... Большие документы требуют больше времени."
+        else:
+            # Операция длится более 2 минут — это уже долго
+            text = f"⌛ {self.operation_name} в процессе..."
+        self.ticks += 1
+        self.send_task = spawn_background(self._send(text), name=f"status-{self.user_id}")
+        delay = STATUS_UPDATE_DELAYS[self.ticks] if self.ticks < len(STATUS_UPDATE_DELAYS) else STATUS_UPDATE_REPEAT_SECONDS
+        self.handle = asyncio.get_running_loop().call_later(delay, self._tick)
+
+    async def _send(self, text: str):
+        try:
+            await self.update.message.reply_text(text)
+        except Exception as e:
+            logger.error(f"[USER_ID: {self.user_id}] - Error in status updates: {e}")
+
+    def cancel(self):
+        self.handle.cancel()
+        if self.send_task is not None:
+            self.send_task.cancel()
+
 
 def _extract_text_from_gemini_response(response) -> str:
     """Best-effort text extraction from Google/Vertex Gemini response object."""
     try:
-        # Prefer unified .text if present
-        text = getattr(response, "text", None)
+        # Prefer unified .text: the SDK walks candidates/parts itself and raises when blocked
+        text = response.text
         if isinstance(text, str) and text.strip():
             return text
-    except Exception:
-        pass
+    except (ValueError, AttributeError) as e:
+        # finish_reason смотрим только когда .text не сработал
+        try:
+            reasons = [str(getattr(c, "finish_reason", None)) for c in (getattr(response, "candidates", None) or [])]
+            logger.warning(f"Gemini response has no .text ({e}); finish_reason={reasons}")
+        except Exception:
+            pass
 
     # Fallback: concatenate parts' text
-    parts_text = []
     try:
-        candidates = getattr(response, "candidates", None) or []
-        for cand in candidates:
-            content = getattr(cand, "content", None)
-            parts = getattr(content, "parts", None) or []
-            for part in parts:
-                # Try part.text first (most common)
-                pt = getattr(part, "text", None)
-                if isinstance(pt, str) and pt:
-                    parts_text.append(pt)
-                    continue
-                # Try inline data (Vertex JSON may come as inline_data)
-                inline = getattr(part, "inline_data", None)
-                if inline is not None:
-                    data = getattr(inline, "data", None)
-                    if data:
-                        try:
-                            # data may already be bytes or base64 string
-                            if isinstance(data, (bytes, bytearray)):
-                                parts_text.append(data.decode("utf-8", errors="ignore"))
-                            elif isinstance(data, str):
-                                import base64 as _b64
-                                parts_text.append(_b64.b64decode(data).decode("utf-8", errors="ignore"))
-                        except Exception:
-                            # ignore decoding failures
-                            pass
+        return "".join(_iter_response_part_texts(response)).strip()
     except Exception:
-        pass
-    return "".join(parts_text).strip()
+        return ""
+
+def _iter_response_part_texts(response):
+    """Yields text of every candidate part: part.text or decoded inline_data."""
+    for cand in getattr(response, "candidates", None) or ():
+        content = getattr(cand, "content", None)
+        for part in getattr(content, "parts", None) or ():
+            # Try part.text first (most common)
+            pt = getattr(part, "text", None)
+            if isinstance(pt, str) and pt:
+                yield pt
+                continue
+            # Try inline data (Vertex JSON may come as inline_data)
+            data = getattr(getattr(part, "inline_data", None), "data", None)
+            if not data:
+                continue
+            try:
+                # data may already be bytes or base64 string
+                if isinstance(data, (bytes, bytearray)):
+                    yield data.decode("utf-8", errors="ignore")
+                elif isinstance(data, str):
+                    yield base64.b64decode(data).decode("utf-8", errors="ignore")
+            except Exception:
+                # ignore decoding failures
+                pass
+
+# raw_decode разбирает JSON с заданной позиции и игнорирует текст после него — без срезов строки
+_JSON_DECODER = json.JSONDecoder()
 
 def _strip_code_fences(s: str) -> str:
     # Remove ```json ... ``` or ``` ... ``` wrappers
     s = s.strip()
     if s.startswith("```"):
         # drop opening fence with optional language
-        s = re.sub(r"^```[a-zA-Z0-9_+-]*\s*", "", s)
+        s = CODE_FENCE_OPEN_RE.sub("", s)
         # drop trailing fence
-        s = re.sub(r"\n?```\s*$", "", s)
+        s = CODE_FENCE_CLOSE_RE.sub("", s)
     return s.strip()
 
+def _iter_top_level_objects(s: str):
+    """Yields top-level {...} segments of the text in a single pass.
+    Braces inside JSON strings (with escapes) are ignored; quotes outside objects are plain prose."""
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(s):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = depth > 0
+        elif ch == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                yield s[start:i + 1]
+
 def _relaxed_json_parse(raw: str) -> dict:
     """Parse JSON allowing common LLM wrappers. Raises JSONDecodeError on failure."""
     s = _strip_code_fences(raw)
     # Quick try
     try:
-        return json.loads(s)
+        return orjson.loads(s)
     except Exception:
         pass
 
@@ -593,38 +955,24 @@ def _relaxed_json_parse(raw: str) -> dict:
     first_brace = s.find("{")
     last_brace = s.rfind("}")
     if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-        candidate = s[first_brace:last_brace + 1]
         try:
-            return json.loads(candidate)
+            return _JSON_DECODER.raw_decode(s, first_brace)[0]
         except Exception:
-            # Try to balance braces by scanning
-            stack = []
-            start = None
-            for i, ch in enumerate(s):
-                if ch == '{':
-                    stack.append('{')
-                    if start is None:
-                        start = i
-                elif ch == '}':
-                    if stack:
-                        stack.pop()
-                        if not stack and start is not None:
-                            try:
-                                return json.loads(s[start:i+1])
-                            except Exception:
-                                start = None
-            # fallthrough
-            pass
+            # Try each top-level {...} segment in turn: one pass over the text, one parse per segment
+            for candidate in _iter_top_level_objects(s):
+                try:
+                    return orjson.loads(candidate)
+                except Exception:
+                    continue
 
     # 2) Array [...]
     first_sq = s.find("[")
     last_sq = s.rfind("]")
     if first_sq != -1 and last_sq != -1 and last_sq > first_sq:
-        candidate = s[first_sq:last_sq + 1]
-        return json.loads(candidate)
+        return _JSON_DECODER.raw_decode(s, first_sq)[0]
 
     # If still not parsed, raise the original error
-    return json.loads(s)
+    return orjson.loads(s)
 
 def parse_gemini_json(response, user_id: int, debug_tag: str = "") -> dict:
     """Unified JSON parsing with diagnostics and relaxed extraction."""
@@ -660,7 +1008,7 @@ def convert_file_sharing_url(url: str) -> str:
     # Google Drive
     if "drive.google.com" in url:
         # Извлекаем ID файла из ссылки
-        match = re.search(r'/d/([a-zA-Z0-9-_]+)', url)
+        match = GDRIVE_FILE_ID_RE.search(url)
         if match:
             file_id = match.group(1)
             return f"https://drive.google.com/uc?export=download&id={file_id}"
@@ -678,6 +1026,43 @@ def convert_file_sharing_url(url: str) -> str:
     # WeTransfer и другие
     return url
 
+async def read_response_body(response: httpx.Response, max_size: int = None) -> bytes:
+    """
+    Читает потоковый ответ в один bytearray без списка чанков и финальной склейки.
+    Если известен Content-Length (и тело не сжато), буфер выделяется сразу нужного размера.
+    Возвращает неизменяемые bytes: PyMuPDF, BytesIO и protobuf копируют bytearray при каждом
+    использовании, а bytes берут без копии — так PDF копируется один раз, здесь.
+    """
+    too_large = "Файл слишком большой ({:.1f} МБ). Максимум " + f"{(max_size or 0) // (1024 * 1024)} МБ."
+    
+    content_length = response.headers.get('content-length')
+    expected = int(content_length) if content_length and content_length.isdigit() else 0
+    if max_size and expected > max_size:
+        raise ValueError(too_large.format(expected / 1024 / 1024))
+    if 'content-encoding' in response.headers:
+        expected = 0  # Content-Length относится к сжатому телу
+    
+    buf = bytearray(expected)
+    view = memoryview(buf)
+    total = 0
+    async for chunk in response.aiter_bytes(chunk_size=65536):
+        end = total + len(chunk)
+        if max_size and end > max_size:
+            raise ValueError(too_large.format(end / 1024 / 1024))
+        if end <= expected:
+            view[total:end] = chunk
+        else:
+            # Тело длиннее заявленного — дальше просто дописываем в конец
+            view.release()
+            del buf[total:]
+            buf += chunk
+            expected = 0
+            view = memoryview(buf)
+        total = end
+    view.release()
+    del buf[total:]
+    return bytes(buf)
+
 async def download_file_from_url(url: str, user_id: int) -> bytes:
     """
     Скачивает файл по ссылке с поддержкой различных файлообменников.
@@ -689,120 +1074,303 @@ async def download_file_from_url(url: str, user_id: int) -> bytes:
     # Конвертируем ссылку если необходимо
     download_url = convert_file_sharing_url(url)
     
-    async with httpx.AsyncClient(timeout=300.0, follow_redirects=True) as client:
-        # Сначала проверяем размер файла
+    # Один потоковый GET вместо HEAD + GET: размер проверяем по заголовку и по ходу скачивания
+    async with http_client.stream("GET", download_url, headers=headers) as response:
+        response.raise_for_status()
+        return await read_response_body(response, MAX_URL_FILE_SIZE)
+
+# --- Gemini Files API и работа с PDF ---
+
+def open_pdf(pdf_bytes: bytes) -> fitz.Document:
+    """Открывает PDF прямо из байтов (без обертки BytesIO и лишней копии)"""
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def _gemini_file_expiration(gemini_file) -> float:
+    """Время истечения файла в Files API (unix time); без поля expiration_time считаем от текущего момента"""
+    expiration_time = getattr(gemini_file, "expiration_time", None)
+    if expiration_time is not None:
         try:
-            head_response = await client.head(download_url, headers=headers)
-            content_length = head_response.headers.get('content-length')
-            if content_length and int(content_length) > 50 * 1024 * 1024:  # 50 MB лимит
-                raise ValueError(f"Файл слишком большой ({int(content_length) / 1024 / 1024:.1f} МБ). Максимум 50 МБ.")
+            return expiration_time.timestamp()
         except Exception:
-            # Если не удалось проверить размер, продолжаем
             pass
-        
-        # Скачиваем файл
-        response = await client.get(download_url, headers=headers)
-        response.raise_for_status()
-        
-        # Проверяем размер после скачивания
-        if len(response.content) > 50 * 1024 * 1024:
-            raise ValueError(f"Файл слишком большой ({len(response.content) / 1024 / 1024:.1f} МБ). Максимум 50 МБ.")
-        
-        return response.content
+    return time.time() + GEMINI_FILE_TTL_SECONDS
 
-def is_valid_file_url(text: str) -> bool:
+async def upload_or_reuse_gemini_file(pdf_bytes: bytes, pdf_digest: str, user_id: int):
     """
-    Проверяет, является ли текст валидной ссылкой на Dropbox.
+    Загружает PDF в Gemini Files API и дожидается состояния ACTIVE, либо переиспользует ранее
+    загруженный файл с тем же содержимым. Повторная отправка того же документа экономит
+    многомегабайтную загрузку и ожидание ACTIVE. В кэш попадают только файлы, дошедшие до ACTIVE.
     """
-    url_pattern = r'https?://[^\s]+'
-    if not re.match(url_pattern, text):
-        return False
-    
-    return 'dropbox.com' in text.lower()
+    digest = pdf_digest
+    cached = gemini_file_cache.get(digest)
+    if cached and time.time() < cached[1] - GEMINI_FILE_REUSE_MARGIN_SECONDS:
+        try:
+            # Для ACTIVE файла это один get_file; FAILED или удаленный файл (NotFound) дают исключение
+            gemini_file = await wait_for_gemini_file_active(SimpleNamespace(name=cached[0]), user_id)
+            gemini_file_cache.move_to_end(digest)
+            logger.info(f"[USER_ID: {user_id}] - Reusing Gemini file {cached[0]} for identical PDF.")
+            return gemini_file
+        except Exception as e:
+            logger.info(f"[USER_ID: {user_id}] - Cached Gemini file {cached[0]} unavailable, re-uploading: {e}")
+            gemini_file_cache.pop(digest, None)
+    gemini_file = await asyncio.to_thread(
+        genai.upload_file, io.BytesIO(pdf_bytes), mime_type="application/pdf", display_name=f"{user_id}.pdf"
+    )
+    try:
+        # Ждем пока файл перейдет в состояние ACTIVE, чтобы избежать 500 Internal errors
+        gemini_file = await wait_for_gemini_file_active(gemini_file, user_id)
+    except Exception:
+        spawn_background(delete_gemini_file(gemini_file.name), name=f"gemini-delete-{user_id}")
+        raise
+    gemini_file_cache[digest] = (gemini_file.name, _gemini_file_expiration(gemini_file))
+    # Файлы больше не удаляются после запроса, поэтому число хранимых ограничено:
+    # иначе за день можно исчерпать квоту хранилища Files API
+    while len(gemini_file_cache) > GEMINI_FILE_CACHE_SIZE:
+        _, (evicted_name, _) = gemini_file_cache.popitem(last=False)
+        spawn_background(delete_gemini_file(evicted_name), name="gemini-evict")
+    return gemini_file
+
+async def delete_gemini_file(file_name: str):
+    """Удаляет файл из Files API; ошибка только логируется (файл мог уже истечь сам)"""
+    try:
+        await asyncio.to_thread(genai.delete_file, file_name)
+    except Exception as e:
+        logger.info(f"Gemini file {file_name} not deleted: {e}")
 
-# --- Google Cloud Storage функции ---
+def start_gemini_upload(pdf_bytes: bytes, pdf_digest: str, user_id: int) -> Optional[asyncio.Task]:
+    """
+    Запускает загрузку PDF в Gemini Files API (вместе с ожиданием ACTIVE) параллельно с открытием
+    и проверкой документа. Для Vertex AI PDF передается inline, поэтому задача не создается.
+    """
+    if USE_VERTEX_AI:
+        return None
+    return asyncio.create_task(upload_or_reuse_gemini_file(pdf_bytes, pdf_digest, user_id))
 
-def prepare_telegram_image(page, user_id: int) -> io.BytesIO:
+def forget_gemini_file(file_name: str):
+    """Убирает файл из кэша загрузок (перед удалением из Files API)"""
+    for digest, (cached_name, _) in list(gemini_file_cache.items()):
+        if cached_name == file_name:
+            del gemini_file_cache[digest]
+
+async def discard_gemini_upload(upload_task: Optional[asyncio.Task], user_id: int):
+    """Удаляет заранее загруженный в Gemini файл, если документ не прошел проверку"""
+    if upload_task is None:
+        return
+    try:
+        gemini_file = await upload_task
+        forget_gemini_file(gemini_file.name)
+        await asyncio.to_thread(genai.delete_file, gemini_file.name)
+    except Exception as e:
+        logger.warning(f"[USER_ID: {user_id}] - Failed to discard Gemini upload: {e}")
+
+async def sweep_gemini_files_periodically():
+    """Раз в GEMINI_FILE_SWEEP_INTERVAL_SECONDS удаляет из Files API истекшие файлы кэша загрузок."""
+    while True:
+        await asyncio.sleep(GEMINI_FILE_SWEEP_INTERVAL_SECONDS)
+        now = time.time()
+        expired = [name for name, expires_at in gemini_file_cache.values() if expires_at - GEMINI_FILE_REUSE_MARGIN_SECONDS <= now]
+        for name in expired:
+            forget_gemini_file(name)
+            await delete_gemini_file(name)
+        if expired:
+            logger.info(f"Gemini file sweep: {len(expired)} expired uploads removed")
+
+def pdf_page_count_hint(pdf_bytes: bytes) -> Optional[int]:
     """
-    Подготавливает изображение страницы для отправки в Telegram
-    с консервативными размерами для максимальной совместимости
+    Быстрая оценка числа страниц по сырым байтам, без разбора xref в MuPDF.
+    Смотрит /Count корневых (без /Parent) несжатых узлов /Pages. Возвращает число, только если оно
+    однозначно: в файле с инкрементальными обновлениями старое дерево страниц остается в байтах,
+    и разные ревизии дают разный /Count. При расхождении или если корень не найден (например,
+    дерево страниц лежит в сжатых object streams) возвращает None — тогда решает fitz.
     """
-    # Telegram Photo API ограничения:
-    # - Размер файла: до 10MB
-    # - Размеры: от 10x10 до 10000x10000 пикселей
-    # - Но есть неявные ограничения на соотношение сторон и общий размер
+    counts = {int(m.group(1)) for node in PDF_PAGES_NODE_RE.finditer(pdf_bytes)
+              if b"/Parent" not in node.group()
+              for m in (PDF_COUNT_RE.search(node.group()),) if m}
+    return counts.pop() if len(counts) == 1 else None
+
+def render_page_preview(pdf_document: fitz.Document, page_number: int, user_id: int) -> io.BytesIO:
+    """
+    Рендерит превью страницы для Telegram; вызывается в cpu_executor
+    (превью 1280px — десятки миллисекунд, см. комментарий у пулов).
+    """
+    page = pdf_document.load_page(page_number - 1)
+    return prepare_telegram_image(page, user_id)
+
+def encode_archive_pixmap(pix: fitz.Pixmap, user_id: int) -> tuple:
+    """Кодирует растр страницы для архива: (байты, "webp"), а если WebP не удался — (байты, "png")"""
+    try:
+        return encode_webp(Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", 0, 1)), "webp"
+    except Exception as e:
+        logger.warning(f"[USER_ID: {user_id}] - WebP conversion failed, saving as PNG: {e}")
+        return pix.tobytes("png"), "png"
+
+def render_page_pixmap(pdf_document: fitz.Document, page_number: int) -> tuple:
+    """
+    Растрирует страницу в 300 DPI и возвращает (pixmap, zoom). Для больших форматов (A1, A0)
+    масштаб сразу ограничиваем лимитом Azure по стороне, чтобы MuPDF не рисовал растр,
+    который потом пришлось бы уменьшать
+    """
+    page = pdf_document.load_page(page_number - 1)
+    zoom = min(OCR_RENDER_DPI / 72, AZURE_MAX_IMAGE_SIDE / max(page.rect.width, page.rect.height))
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False), zoom
+
+def render_page_for_archive(pdf_bytes: Optional[bytes], page_number: int, user_id: int, ocr_png: Optional[bytes] = None) -> tuple:
+    """
+    Готовит изображение страницы для архива: (байты, "webp" или "png"). Выполняется в render_executor
+    отдельной задачей, параллельно с Azure и Gemini. Если для OCR ушел PNG полного разрешения (ocr_png),
+    это тот же растр — он перекодируется в WebP без повторного рендера (и без передачи PDF в процесс).
+    """
+    if ocr_png is not None:
+        try:
+            with Image.open(io.BytesIO(ocr_png)) as image:
+                return encode_webp(image), "webp"
+        except Exception as e:
+            logger.warning(f"[USER_ID: {user_id}] - WebP conversion failed, saving as PNG: {e}")
+            return ocr_png, "png"
+    pdf_document = open_pdf(pdf_bytes)
+    try:
+        archive_pix, _ = render_page_pixmap(pdf_document, page_number)
+    finally:
+        pdf_document.close()
+    return encode_archive_pixmap(archive_pix, user_id)
+
+def render_page_for_ocr(pdf_bytes: bytes, page_number: int, max_file_size: int, user_id: int) -> dict:
+    """
+    Растрирует страницу в 300 DPI (не больше AZURE_MAX_IMAGE_SIDE по стороне) и готовит байты
+    для Azure OCR. Выполняется в render_executor (отдельный процесс), поэтому принимает
+    и возвращает только picklable-данные:
+    {"page_count"} если страницы нет, иначе еще "dpi", "size", "ocr_bytes", "ocr_variant"
+    и "ocr_is_full_png" — OCR получил PNG полного растра, пригодный для архива.
+    Наружу отдаются только закодированные байты, а не сырой RGB растр (~25MB для A4):
+    архивное изображение готовит отдельная задача render_page_for_archive.
+    """
+    pdf_document = open_pdf(pdf_bytes)
+    try:
+        # Проверяем, что страница существует
+        page_count = len(pdf_document)
+        if page_number > page_count:
+            return {"page_count": page_count}
+        
+        # Растрируем страницу один раз в 300 DPI.
+        # Если PNG не влезает в лимит Azure, пробуем JPEG и уменьшение того же растра,
+        # а не повторный рендер страницы с меньшим DPI.
+        archive_pix, zoom = render_page_pixmap(pdf_document, page_number)
+    finally:
+        pdf_document.close()
+    
+    dpi = round(zoom * 72)
+    # Размер PNG оцениваем по уменьшенной в 4 раза по стороне копии (1/16 пикселей): для сканов
+    # он заведомо больше лимита, и полное PNG-кодирование 300 DPI растра было бы потрачено впустую
+    probe_pix = fitz.Pixmap(archive_pix)
+    probe_pix.shrink(2)
+    estimated_png_size = len(probe_pix.tobytes("png")) * 16
+    probe_pix = None
+    if estimated_png_size > 2 * max_file_size:
+        logger.info(f"[USER_ID: {user_id}] - Estimated PNG at {dpi} DPI ~{estimated_png_size / 1024 / 1024:.1f}MB, skipping PNG")
+        ocr_bytes = None
+    else:
+        ocr_bytes = archive_pix.tobytes("png")
+        ocr_variant = f"PNG {dpi} DPI"
+    ocr_is_full_png = ocr_bytes is not None and len(ocr_bytes) <= max_file_size
+    if ocr_bytes is None or len(ocr_bytes) > max_file_size:
+        if ocr_bytes is not None:
+            logger.warning(f"[USER_ID: {user_id}] - PNG at {dpi} DPI too large ({len(ocr_bytes) / 1024 / 1024:.1f}MB), trying JPEG...")
+        ocr_bytes = archive_pix.tobytes("jpg", jpg_quality=85)
+        ocr_variant = f"JPEG {dpi} DPI"
+        if len(ocr_bytes) > max_file_size:
+            # Размер JPEG примерно пропорционален качеству: одна оценка вместо перебора 75/65/55,
+            # и только если не помогло — теряем разрешение, которое для OCR важнее
+            quality = max(OCR_MIN_JPEG_QUALITY, min(85, int(85 * max_file_size / len(ocr_bytes))))
+            ocr_bytes = archive_pix.tobytes("jpg", jpg_quality=quality)
+            ocr_variant = f"JPEG {dpi} DPI q{quality}"
+    if len(ocr_bytes) > max_file_size:
+        logger.warning(f"[USER_ID: {user_id}] - JPEG at {dpi} DPI too large ({len(ocr_bytes) / 1024 / 1024:.1f}MB), downscaling...")
+        ocr_pix = fitz.Pixmap(archive_pix)
+        ocr_pix.shrink(1)  # уменьшение в 2 раза по каждой стороне
+        ocr_bytes = None
+        if estimated_png_size / 4 <= 2 * max_file_size:  # та же оценка: пикселей вчетверо меньше
+            ocr_bytes = ocr_pix.tobytes("png")
+            ocr_variant = f"PNG {dpi // 2} DPI"
+        if ocr_bytes is None or len(ocr_bytes) > max_file_size:
+            ocr_bytes = ocr_pix.tobytes("jpg", jpg_quality=85)
+            ocr_variant = f"JPEG {dpi // 2} DPI"
     
-    # Используем консервативные лимиты для стабильной работы
-    MAX_WIDTH = 4096   # Консервативный лимит вместо 10000
-    MAX_HEIGHT = 4096  # Консервативный лимит вместо 10000 
-    MAX_FILE_SIZE_MB = 8  # Консервативный лимит вместо 10MB
+    return {
+        "page_count": page_count,
+        "dpi": dpi,
+        "size": (archive_pix.width, archive_pix.height),
+        "ocr_bytes": ocr_bytes,
+        "ocr_variant": ocr_variant,
+        "ocr_is_full_png": ocr_is_full_png,
+    }
+
+async def get_page_preview(pdf_document: fitz.Document, pdf_digest: str, page_number: int, user_id: int) -> io.BytesIO:
+    """
+    Возвращает превью страницы для Telegram из LRU-кэша, рендеря его только при промахе.
+    Повторная отправка того же документа (например, после неудачной ссылки) обходится без MuPDF/Pillow.
+    pdf_digest — sha256 PDF, считается один раз на документ в open_pdf_for_analysis.
+    """
+    loop = asyncio.get_running_loop()
+    key = (pdf_digest, page_number)
     
-    # Создаем изображение с умеренным DPI
-    pix = page.get_pixmap(dpi=150)
-    png_bytes = pix.tobytes("png")
-    image = Image.open(io.BytesIO(png_bytes))
+    image_bytes = preview_cache.get(key)
+    if image_bytes is not None:
+        preview_cache.move_to_end(key)
+        logger.info(f"[USER_ID: {user_id}] - Preview for page {page_number} served from cache")
+    else:
+        img_buffer = await loop.run_in_executor(cpu_executor, render_page_preview, pdf_document, page_number, user_id)
+        image_bytes = img_buffer.getvalue()
+        preview_cache[key] = image_bytes
+        if len(preview_cache) > PREVIEW_CACHE_SIZE:
+            preview_cache.popitem(last=False)
     
-    original_width, original_height = image.size
-    logger.info(f"[USER_ID: {user_id}] - Original image: {original_width}x{original_height}")
+    # Telegram вычитывает буфер, поэтому на каждый вызов — свой BytesIO
+    return io.BytesIO(image_bytes)
+
+async def prerender_page_previews(pdf_document: fitz.Document, pdf_digest: str, user_id: int):
+    """
+    Заранее кладет в кэш превью всех страниц короткого документа, пока Gemini ищет нужную.
+    Страницы рендерятся последовательно: один fitz.Document нельзя использовать из нескольких потоков.
+    """
+    for page_number in range(1, len(pdf_document) + 1):
+        await get_page_preview(pdf_document, pdf_digest, page_number, user_id)
+
+def prepare_telegram_image(page, user_id: int) -> io.BytesIO:
+    """
+    Подготавливает изображение страницы для отправки в Telegram.
+    Telegram все равно пережимает фото до 1280px по длинной стороне, поэтому сразу
+    отправляем именно такой JPEG — без лишнего трафика и без ошибок Photo_invalid_dimensions
+    """
+    MAX_SIDE = 1280  # Максимальный размер фото, который Telegram показывает без пережатия
+    MAX_RATIO = 20   # Telegram отклоняет фото с соотношением сторон больше 20:1
     
-    # Масштабируем если превышены лимиты
-    if original_width > MAX_WIDTH or original_height > MAX_HEIGHT:
-        # Рассчитываем коэффициент масштабирования сохраняя пропорции
-        scale_factor = min(MAX_WIDTH / original_width, MAX_HEIGHT / original_height)
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
-        
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        logger.info(f"[USER_ID: {user_id}] - Resized to: {new_width}x{new_height} (scale: {scale_factor:.2f})")
+    # Слишком вытянутую страницу обрезаем до 20:1 от верхнего/левого края — таблица
+    # обычно начинается там. После этого короткая сторона при 1280px не меньше 64px,
+    # и минимальный размер Telegram (10px) соблюдается без увеличения масштаба
+    clip = fitz.Rect(page.rect)
+    if clip.height > clip.width * MAX_RATIO:
+        clip.y1 = clip.y0 + clip.width * MAX_RATIO
+    elif clip.width > clip.height * MAX_RATIO:
+        clip.x1 = clip.x0 + clip.height * MAX_RATIO
     
-    # Проверяем минимальные размеры
-    if image.width < 10 or image.height < 10:
-        scale_factor = max(15 / image.width, 15 / image.height)
-        new_width = int(image.width * scale_factor)
-        new_height = int(image.height * scale_factor)
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        logger.info(f"[USER_ID: {user_id}] - Upscaled to meet minimum: {new_width}x{new_height}")
+    # Масштаб считаем заранее: не больше 150 DPI и не больше 1280px по длинной стороне,
+    # чтобы MuPDF сразу отрисовал итоговый размер без PNG и ресайза в Pillow
+    zoom = min(150 / 72, MAX_SIDE / max(clip.width, clip.height))
     
-    # Сначала пробуем PNG
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format='PNG', optimize=True)
-    img_buffer.seek(0)
-    file_size_mb = len(img_buffer.getvalue()) / 1024 / 1024
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False, colorspace=fitz.csRGB)
+    logger.info(f"[USER_ID: {user_id}] - Rendered preview: {pix.width}x{pix.height} (zoom {zoom:.2f})")
     
-    # Если PNG слишком большой, конвертируем в JPEG
-    if file_size_mb > MAX_FILE_SIZE_MB:
-        logger.warning(f"[USER_ID: {user_id}] - PNG too large ({file_size_mb:.1f}MB), converting to JPEG")
-        img_buffer = io.BytesIO()
-        
-        # Пробуем разные уровни качества
-        for quality in [85, 75, 65, 55]:
-            img_buffer = io.BytesIO()
-            image.save(img_buffer, format='JPEG', quality=quality, optimize=True)
-            img_buffer.seek(0)
-            file_size_mb = len(img_buffer.getvalue()) / 1024 / 1024
-            
-            if file_size_mb <= MAX_FILE_SIZE_MB:
-                logger.info(f"[USER_ID: {user_id}] - JPEG quality {quality}: {file_size_mb:.1f}MB")
-                break
-        
-        # Если все еще слишком большой, дополнительно уменьшаем размер
-        if file_size_mb > MAX_FILE_SIZE_MB:
-            scale_factor = 0.8
-            new_width = int(image.width * scale_factor)
-            new_height = int(image.height * scale_factor)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            img_buffer = io.BytesIO()
-            image.save(img_buffer, format='JPEG', quality=75, optimize=True)
-            img_buffer.seek(0)
-            file_size_mb = len(img_buffer.getvalue()) / 1024 / 1024
-            logger.info(f"[USER_ID: {user_id}] - Final resize: {new_width}x{new_height}, {file_size_mb:.1f}MB")
+    # 1280px JPEG заведомо укладывается в лимит 10MB — подбор качества не нужен
+    img_buffer = io.BytesIO(pix.pil_tobytes("JPEG", quality=85, optimize=True, progressive=True))
     
     final_size_mb = len(img_buffer.getvalue()) / 1024 / 1024
-    logger.info(f"[USER_ID: {user_id}] - Final Telegram image: {image.width}x{image.height}, {final_size_mb:.1f}MB")
+    logger.info(f"[USER_ID: {user_id}] - Final Telegram image: {pix.width}x{pix.height}, {final_size_mb:.1f}MB")
     
     return img_buffer
 
+# --- Сохранение данных: Yandex Object Storage, кэш спецификаций, отладочные файлы ---
+
+@functools.lru_cache(maxsize=1024)
 def clean_filename(filename: str) -> str:
     """Очищает имя файла для использования в GCS"""
     if not filename:
@@ -813,28 +1381,101 @@ def clean_filename(filename: str) -> str:
     # Заменяем пробелы на подчеркивания
     name = name.replace(" ", "_")
     # Оставляем только алфавит, цифры и подчеркивания
-    name = re.sub(r'[^a-zA-Zа-яёА-ЯЁ0-9_]', '', name)
+    name = FILENAME_DISALLOWED_RE.sub('', name)
     
     return name or "unknown"
 
+_last_utc_timestamp = (0, "")
+
 def format_utc_timestamp() -> str:
     """Форматирует текущее время в UTC для имени папки"""
-    now = datetime.now(timezone.utc)
-    # Формат: 2025-08-02T14-30-45Z (двоеточия заменены на дефисы)
-    return now.strftime("%Y-%m-%dT%H-%M-%SZ")
+    global _last_utc_timestamp
+    # Строка меняется раз в секунду — в пределах одной секунды отдаем закэшированную
+    second = int(time.time())
+    if _last_utc_timestamp[0] != second:
+        now = datetime.fromtimestamp(second, timezone.utc)
+        # Формат: 2025-08-02T14-30-45Z (двоеточия заменены на дефисы)
+        _last_utc_timestamp = (second, now.strftime("%Y-%m-%dT%H-%M-%SZ"))
+    return _last_utc_timestamp[1]
+
+def _write_bytes(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+async def write_file_async(path: str, data: bytes):
+    """Пишет файл на диск в потоке, чтобы запись не блокировала event loop"""
+    await asyncio.to_thread(_write_bytes, path, data)
+
+async def save_debug_file(file_name: str, data: bytes, user_id: int):
+    """Сохраняет отладочный файл в TEMP_DIR; ошибка записи только логируется и не прерывает обработку"""
+    path = os.path.join(TEMP_DIR, file_name)
+    try:
+        await asyncio.to_thread(os.makedirs, TEMP_DIR, exist_ok=True)
+        await write_file_async(path, data)
+        logger.info(f"[USER_ID: {user_id}] - Debug file saved to {path}")
+    except OSError as e:
+        logger.warning(f"[USER_ID: {user_id}] - Failed to save debug file {path}: {e}")
+
+async def run_storage(func, *args, **kwargs):
+    """Выполняет блокирующий вызов yandex_storage в пуле потоков, не останавливая event loop."""
+    return await asyncio.get_running_loop().run_in_executor(storage_executor, functools.partial(func, *args, **kwargs))
+
+def encode_webp(image: Image.Image) -> bytes:
+    """Кодирует изображение страницы в WebP для архива.
+
+    quality=90 визуально не отличается от lossless для сканов, но кодируется в разы быстрее;
+    method=1 почти не проигрывает method=4 в размере, а растр 300 DPI кодирует в несколько раз быстрее.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='WEBP', quality=90, method=1)
+    return buffer.getvalue()
+
+def spec_cache_path(pdf_digest: str, page_number: int) -> str:
+    """
+    Ключ кэша результатов обработки страницы: хэш PDF (sha256 из open_pdf_for_analysis) + номер страницы
+    + хэш промпта извлечения, чтобы правка extract_and_correct.txt не отдавала устаревшие результаты.
+    """
+    prompt_digest = hashlib.blake2b(prompt_bytes(get_prompt("extract_and_correct.txt")), digest_size=6).hexdigest()
+    return f"{SPEC_CACHE_PREFIX}/{pdf_digest}/page_{page_number}_{prompt_digest}.json.zst"
+
+def _load_spec_cache(cache_path: str) -> Optional[dict]:
+    data = yandex_storage.download_bytes(cache_path)
+    if not data:
+        return None
+    return orjson.loads(zstandard.ZstdDecompressor().decompress(data))
+
+def _store_spec_cache(cache_path: str, ocr_html: str, corrected_json: dict) -> bool:
+    payload = orjson.dumps({"ocr_html": ocr_html, "corrected_json": corrected_json}, option=orjson.OPT_NON_STR_KEYS)
+    # zstd сжимает JSON не хуже gzip, но заметно быстрее и при записи, и при чтении
+    return yandex_storage.upload_string(zstandard.ZstdCompressor(level=3).compress(payload), cache_path, 'application/zstd')
+
+async def load_spec_cache(cache_path: str, user_id: int) -> Optional[dict]:
+    """Возвращает сохраненные {ocr_html, corrected_json} для страницы или None при промахе/ошибке."""
+    if not yandex_storage.client:
+        return None
+    try:
+        cached = await run_storage(_load_spec_cache, cache_path)
+    except Exception as e:
+        logger.warning(f"[USER_ID: {user_id}] - Failed to read spec cache {cache_path}: {e}")
+        return None
+    if cached:
+        logger.info(f"[USER_ID: {user_id}] - Spec cache hit: {cache_path}")
+    return cached
 
 async def save_to_yandex_initial(
     user_id: int,
     pdf_name: str,
-    page_image_bytes: bytes,
-    ocr_html: str,
-    corrected_json: dict,
+    page_image: Optional[asyncio.Future],
+    ocr_html: bytes,
+    corrected_json_bytes: bytes,
     find_prompt: str,
     extract_prompt: str
 ) -> Optional[str]:
     """
     Сохраняет начальные данные в Yandex Object Storage БЕЗ создания parquet
     Возвращает base_path для последующего использования
+    page_image — уже запущенное кодирование изображения страницы (render_page_for_archive),
+    результат — (байты, "webp" или "png")
     """
     if not yandex_storage.client:
         logger.warning("Yandex Storage not configured, skipping initial save")
@@ -848,52 +1489,38 @@ async def save_to_yandex_initial(
         
         logger.info(f"[USER_ID: {user_id}] - Initial save to Yandex Storage: {base_path}")
         
-        # 1. Сохраняем input.webp (конвертируем в WebP lossless)
-        try:
-            webp_buffer = io.BytesIO()
-            image = Image.open(io.BytesIO(page_image_bytes))
-            image.save(webp_buffer, format='WEBP', lossless=True)
-            webp_bytes = webp_buffer.getvalue()
-            
-            # Сохраняем как временный файл и загружаем
-            temp_webp = f"/tmp/temp_webp_{user_id}.webp"
-            with open(temp_webp, 'wb') as f:
-                f.write(webp_bytes)
-            
-            if not yandex_storage.upload_file(temp_webp, f"{base_path}/input.webp", 'image/webp'):
-                raise Exception("Failed to upload WebP")
-            
-            os.remove(temp_webp)
-            
-        except Exception as img_error:
-            # Для тестирования сохраняем как PNG
-            logger.warning(f"[USER_ID: {user_id}] - WebP conversion failed, saving as PNG: {img_error}")
-            temp_png = f"/tmp/temp_png_{user_id}.png"
-            with open(temp_png, 'wb') as f:
-                f.write(page_image_bytes)
-            
-            if not yandex_storage.upload_file(temp_png, f"{base_path}/input.png", 'image/png'):
-                raise Exception("Failed to upload PNG")
-            
-            os.remove(temp_png)
-        
-        # 2. Сохраняем ocr_raw.html.gz
-        if not yandex_storage.upload_gzipped_string(ocr_html, f"{base_path}/ocr_raw.html.gz", 'text/html'):
-            raise Exception("Failed to upload OCR HTML")
+        processing_id = str(uuid.uuid4())
+        # Метаданные объектов передаются тем же PUT запросом: по ним можно фильтровать записи
+        # без скачивания meta.json
+        object_args = {
+            "metadata": {"user_id": str(user_id), "processing_id": processing_id, "feedback_status": "pending"},
+            "cache_control": "no-cache",
+        }
         
-        # 3. Сохраняем corrected.json
-        if not yandex_storage.upload_json(corrected_json, f"{base_path}/corrected.json"):
-            raise Exception("Failed to upload corrected JSON")
+        # 1. ocr_raw.html.zst, corrected.json и промпты не зависят от изображения — запускаем их
+        # загрузку сразу, параллельно друг с другом и с кодированием input.webp:
+        # каждая загрузка — отдельный HTTPS запрос, последовательно они складывают задержки
+        uploads = [
+            # zstd уровня 3 сжимает HTML таблиц быстрее gzip и заметно плотнее
+            ("OCR HTML", functools.partial(yandex_storage.upload_zstd_string, ocr_html, f"{base_path}/{OCR_HTML_FILE}", 'text/html', **object_args)),
+            ("corrected JSON", functools.partial(yandex_storage.upload_string, corrected_json_bytes, f"{base_path}/corrected.json", 'application/json; charset=utf-8', **object_args)),
+            ("find prompt", functools.partial(yandex_storage.upload_bytes, prompt_bytes(find_prompt), f"{base_path}/find_prompt.txt", 'text/plain', **object_args)),
+            ("extract prompt", functools.partial(yandex_storage.upload_bytes, prompt_bytes(extract_prompt), f"{base_path}/extract_prompt.txt", 'text/plain', **object_args)),
+        ]
+        upload_futures = [asyncio.ensure_future(run_storage(upload)) for _, upload in uploads]
         
-        # 4. Сохраняем find_prompt.txt
-        if not yandex_storage.upload_string(find_prompt, f"{base_path}/find_prompt.txt", 'text/plain'):
-            raise Exception("Failed to upload find prompt")
+        # 2. Изображение грузим прямо из памяти, как только закончится его кодирование, и ждем все загрузки разом
+        image_bytes, image_format = await page_image
+        image_file = f"input.{image_format}"
+        uploads.append(("page image", functools.partial(yandex_storage.upload_bytes, image_bytes, f"{base_path}/{image_file}", f"image/{image_format}", **object_args)))
+        upload_futures.append(asyncio.ensure_future(run_storage(uploads[-1][1])))
+        results = await asyncio.gather(*upload_futures)
         
-        # 5. Сохраняем extract_prompt.txt
-        if not yandex_storage.upload_string(extract_prompt, f"{base_path}/extract_prompt.txt", 'text/plain'):
-            raise Exception("Failed to upload extract prompt")
+        failed = [name for (name, _), ok in zip(uploads, results) if not ok]
+        if failed:
+            raise Exception(f"Failed to upload {', '.join(failed)}")
         
-        # 6. Сохраняем meta.json
+        # 3. Сохраняем meta.json последним — его наличие означает, что запись сохранена целиком
         meta_data = {
             "user_id": user_id,
             "pdf_name": pdf_name,
@@ -902,11 +1529,13 @@ async def save_to_yandex_initial(
             "timestamp_iso": datetime.now(timezone.utc).isoformat(),
             "find_prompt_length": len(find_prompt),
             "extract_prompt_length": len(extract_prompt),
-            "processing_id": str(uuid.uuid4()),
+            "processing_id": processing_id,
+            "image_file": image_file,  # input.webp или input.png
+            "ocr_file": OCR_HTML_FILE,
             "feedback_status": "pending"  # Ожидаем обратную связь
         }
         
-        if not yandex_storage.upload_json(meta_data, f"{base_path}/meta.json"):
+        if not await run_storage(yandex_storage.upload_json, meta_data, f"{base_path}/meta.json", **object_args):
             raise Exception("Failed to upload meta JSON")
         
         logger.info(f"[USER_ID: {user_id}] - Initial save successful: {base_path}")
@@ -916,44 +1545,51 @@ async def save_to_yandex_initial(
         logger.error(f"[USER_ID: {user_id}] - Error in save_to_yandex_initial: {e}", exc_info=True)
         return None
 
-def schedule_feedback_timeout(user_id: int, base_path: str, timeout_seconds: int = 1800):
+def _on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed: {task.exception()}", exc_info=task.exception())
+
+def spawn_background(coro, name: str = None) -> asyncio.Task:
+    """Запускает корутину в фоне, удерживая ссылку на задачу до ее завершения (иначе ее может собрать GC)"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+def schedule_feedback_timeout(user_id: int, base_path: str, timeout_seconds: int = 1800, corrected_data: dict = None):
     """
     Планирует задачу на обработку timeout для обратной связи (30 минут)
+    corrected_data — уже разобранный corrected.json, чтобы при финализации не скачивать его обратно
     """
-    def timeout_handler():
-        time.sleep(timeout_seconds)
-        # Проверяем, что задача не была отменена
-        if user_id in pending_feedback_tasks and not pending_feedback_tasks[user_id].get("cancel", False):
-            logger.info(f"[USER_ID: {user_id}] - Feedback timeout reached, finalizing with 'timeout'")
-            # Запускаем финализацию асинхронно
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(finalize_yandex_entry(base_path, "timeout"))
-            loop.close()
-            # Удаляем задачу из pending
-            pending_feedback_tasks.pop(user_id, None)
+    async def finalize_on_timeout():
+        pending_feedback_tasks.pop(user_id, None)
+        logger.info(f"[USER_ID: {user_id}] - Feedback timeout reached, finalizing with 'timeout'")
+        await finalize_yandex_entry(base_path, "timeout", corrected_data)
     
-    # Отменяем предыдущую задачу если есть
-    if user_id in pending_feedback_tasks:
-        pending_feedback_tasks[user_id]["cancel"] = True
+    def on_timeout():
+        spawn_background(finalize_on_timeout())
     
-    # Сохраняем данные задачи
-    pending_feedback_tasks[user_id] = {
-        "base_path": base_path,
-        "cancel": False,
-        "started_at": datetime.now(timezone.utc)
-    }
+    # Отменяем предыдущую задачу если есть; ее запись закрываем сразу как timeout,
+    # иначе она так и осталась бы без parquet-записи
+    previous = pending_feedback_tasks.get(user_id)
+    if previous:
+        previous.handle.cancel()
+        spawn_background(finalize_yandex_entry(previous.base_path, "timeout", previous.corrected_data), name=f"finalize-{user_id}")
     
-    # Запускаем таймер в отдельном потоке
-    thread = threading.Thread(target=timeout_handler, daemon=True)
-    thread.start()
+    # Таймер на текущем event loop вместо отдельного потока со sleep
+    handle = asyncio.get_running_loop().call_later(timeout_seconds, on_timeout)
+    
+    # Сохраняем данные задачи
+    pending_feedback_tasks[user_id] = PendingFeedback(base_path, handle, datetime.now(timezone.utc), corrected_data)
     
     logger.info(f"[USER_ID: {user_id}] - Scheduled feedback timeout in {timeout_seconds//60} minutes")
 
-async def finalize_yandex_entry(base_path: str, feedback_status: str):
+async def finalize_yandex_entry(base_path: str, feedback_status: str, corrected_data: dict = None):
     """
     Финализирует запись в Yandex Storage: обновляет meta.json и создает parquet
     feedback_status: 'good', 'bad', или 'timeout'
+    corrected_data — разобранный corrected.json, если он еще в памяти (иначе скачивается)
     """
     if not yandex_storage.client:
         logger.warning("Yandex Storage not configured, skipping finalization")
@@ -962,48 +1598,49 @@ async def finalize_yandex_entry(base_path: str, feedback_status: str):
     try:
         logger.info(f"Finalizing Yandex entry: {base_path} with feedback: {feedback_status}")
         
-        # 1. Читаем и обновляем meta.json с feedback_status
-        # Создаем временный файл для скачивания
-        temp_meta = f"/tmp/temp_meta_{uuid.uuid4().hex}.json"
+        # Одна отметка времени на событие: и для meta.json, и для feedback.txt
+        feedback_time = datetime.now(timezone.utc).isoformat()
         
-        if yandex_storage.download_file(f"{base_path}/meta.json", temp_meta):
-            with open(temp_meta, 'r', encoding='utf-8') as f:
-                meta_data = json.load(f)
-            
-            meta_data["feedback_status"] = feedback_status
-            meta_data["feedback_received_at"] = datetime.now(timezone.utc).isoformat()
-            
-            # Сохраняем обновленный meta.json
-            if not yandex_storage.upload_json(meta_data, f"{base_path}/meta.json"):
-                raise Exception("Failed to upload updated meta.json")
-            
-            os.remove(temp_meta)
-        else:
+        # 1. Читаем meta.json (в память) и помечаем feedback_status в метаданных объекта.
+        # Тело meta.json остается снимком на момент сохранения; статус обновляется server-side
+        # копированием метаданных, без повторной заливки JSON
+        meta_bytes = await run_storage(yandex_storage.download_bytes, f"{base_path}/meta.json")
+        if not meta_bytes:
             logger.error(f"Meta.json not found at {base_path}/meta.json")
             return
         
-        # 2. Создаем feedback.txt
-        feedback_messages = {
-            "good": f"Пользователь доволен результатом обработки\nВремя обратной связи: {datetime.now(timezone.utc).isoformat()}",
-            "bad": f"Пользователь НЕ доволен результатом обработки\nВремя обратной связи: {datetime.now(timezone.utc).isoformat()}\nКонтакт админа: @aianback",
-            "timeout": f"Пользователь не предоставил обратную связь (timeout)\nВремя истечения: {datetime.now(timezone.utc).isoformat()}"
+        meta_data = orjson.loads(meta_bytes)
+        meta_data["feedback_status"] = feedback_status
+        meta_data["feedback_received_at"] = feedback_time
+        
+        object_metadata = {
+            "user_id": str(meta_data.get("user_id", "")),
+            "processing_id": meta_data.get("processing_id", ""),
+            "feedback_status": feedback_status,
+            "feedback_received_at": feedback_time,
         }
+        if not await run_storage(yandex_storage.update_metadata, f"{base_path}/meta.json", object_metadata,
+                                 content_type="application/json", cache_control="no-cache"):
+            raise Exception("Failed to update meta.json metadata")
         
-        feedback_content = feedback_messages.get(feedback_status, "Unknown feedback status")
-        if not yandex_storage.upload_string(feedback_content, f"{base_path}/feedback.txt", 'text/plain'):
+        # 2. Создаем feedback.txt
+        feedback_content = FEEDBACK_MESSAGES.get(feedback_status, "Unknown feedback status").format(time=feedback_time)
+        if not await run_storage(yandex_storage.upload_string, feedback_content, f"{base_path}/feedback.txt", 'text/plain'):
             raise Exception("Failed to upload feedback.txt")
         
         # 3. Создаем parquet запись
-        await create_parquet_entry_yandex(base_path, meta_data, feedback_status)
+        await create_parquet_entry_yandex(base_path, meta_data, feedback_status, corrected_data)
         
         logger.info(f"Successfully finalized Yandex entry: {base_path}")
         
     except Exception as e:
         logger.error(f"Error finalizing Yandex entry {base_path}: {e}", exc_info=True)
 
-async def create_parquet_entry_yandex(base_path: str, meta_data: dict, feedback_status: str):
+async def create_parquet_entry_yandex(base_path: str, meta_data: dict, feedback_status: str, corrected_data: dict = None):
     """
-    Создает запись в ежедневном parquet файле в Yandex Storage
+    Создает запись в ежедневном parquet датасете в Yandex Storage.
+    Каждая запись пишется отдельным файлом dataset/YYYY-MM-DD/part-<processing_id>.parquet,
+    чтобы не скачивать и не перезаписывать весь дневной файл на каждый отзыв.
     """
     try:
         if not yandex_storage.client:
@@ -1011,39 +1648,21 @@ async def create_parquet_entry_yandex(base_path: str, meta_data: dict, feedback_
         
         # Получаем дату для имени файла
         today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        parquet_path = f"dataset/{today}.parquet"
         
-        # Загружаем corrected.json для анализа
-        temp_corrected = f"/tmp/temp_corrected_{uuid.uuid4().hex}.json"
-        corrected_data = {}
-        
-        if yandex_storage.download_file(f"{base_path}/corrected.json", temp_corrected):
-            with open(temp_corrected, 'r', encoding='utf-8') as f:
-                corrected_data = json.load(f)
-            os.remove(temp_corrected)
+        # corrected.json для анализа: берем из памяти, а скачиваем (сразу в память) только если его там нет
+        if corrected_data is None:
+            corrected_bytes = await run_storage(yandex_storage.download_bytes, f"{base_path}/corrected.json")
+            corrected_data = orjson.loads(corrected_bytes) if corrected_bytes else {}
         
         # Подсчитываем статистику профилей
-        profiles_count = 0
-        total_mass = 0.0
-        profile_types = set()
-        
-        if "профили" in corrected_data:
-            for profile_name, profile_data in corrected_data["профили"].items():
-                profiles_count += 1
-                profile_types.add(profile_name)
-                if isinstance(profile_data, dict) and "марки_стали" in profile_data:
-                    for steel_grade, steel_data in profile_data["марки_стали"].items():
-                        if isinstance(steel_data, dict) and "размеры" in steel_data:
-                            for size_name, size_data in steel_data["размеры"].items():
-                                if isinstance(size_data, dict) and "элементы" in size_data:
-                                    for element in size_data["элементы"]:
-                                        if isinstance(element, dict) and "масса" in element:
-                                            try:
-                                                total_mass += float(element["масса"])
-                                            except (ValueError, TypeError):
-                                                pass
+        profiles = corrected_data.get("профили") or {}
+        profiles_count = len(profiles)
+        profile_types = set(profiles)
+        
+        total_mass = math.fsum(iter_spec_masses(corrected_data))
         
         # Создаем запись для parquet
+        storage_uri = f"s3://{yandex_storage.bucket_name}/{base_path}"
         record = {
             "timestamp": meta_data.get("timestamp_iso", datetime.now(timezone.utc).isoformat()),
             "user_id": meta_data.get("user_id", 0),
@@ -1055,49 +1674,107 @@ async def create_parquet_entry_yandex(base_path: str, meta_data: dict, feedback_
             "unique_profile_types": len(profile_types),
             "find_prompt_length": meta_data.get("find_prompt_length", 0),
             "extract_prompt_length": meta_data.get("extract_prompt_length", 0),
-            "yandex_path": base_path
+            "yandex_path": base_path,
+            # Бинарные артефакты лежат отдельными объектами, в parquet — только ссылки на них
+            "image_uri": f"{storage_uri}/{meta_data.get('image_file', 'input.webp')}",
+            # Записи, сохраненные до перехода на zstd, ссылаются на ocr_raw.html.gz
+            "ocr_html_uri": f"{storage_uri}/{meta_data.get('ocr_file', 'ocr_raw.html.gz')}",
+            "corrected_uri": f"{storage_uri}/corrected.json",
         }
         
-        # Проверяем существует ли уже parquet файл за сегодня
-        temp_parquet = f"/tmp/temp_parquet_{uuid.uuid4().hex}.parquet"
-        
-        if yandex_storage.file_exists(parquet_path):
-            # Загружаем существующий файл
-            if yandex_storage.download_file(parquet_path, temp_parquet):
-                # Читаем существующие данные
-                existing_df = pd.read_parquet(temp_parquet)
-                
-                # Добавляем новую запись
-                new_df = pd.DataFrame([record])
-                combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-                
-                os.remove(temp_parquet)
-            else:
-                # Ошибка при загрузке - создаем новый DataFrame
-                combined_df = pd.DataFrame([record])
-        else:
-            # Создаем новый DataFrame
-            combined_df = pd.DataFrame([record])
-        
-        # Сохраняем обновленный parquet
-        combined_df.to_parquet(temp_parquet, index=False)
-        
-        if yandex_storage.upload_file(temp_parquet, parquet_path, 'application/octet-stream'):
-            logger.info(f"Updated parquet dataset: {parquet_path} (total records: {len(combined_df)})")
+        # Пишем запись отдельным файлом в папку дня (Hive-подобный датасет из мелких файлов)
+        parquet_path = f"dataset/{today}/part-{record['processing_id']}.parquet"
+        # Для маленьких файлов-записей snappy: сжатие почти такое же, как у zstd, а CPU в разы меньше.
+        # zstd имеет смысл только при склейке дня в один большой файл.
+        # Словари и статистика колонок для одной строки — чистые накладные расходы, их строит компактизация.
+        # Пишем в память и грузим оттуда же — без временного файла в /tmp
+        parquet_buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pylist([record], schema=PARQUET_RECORD_SCHEMA), parquet_buffer,
+                       compression='snappy', use_dictionary=False, write_statistics=False)
+        
+        if await run_storage(yandex_storage.upload_bytes, parquet_buffer.getvalue(), parquet_path, 'application/octet-stream'):
+            logger.info(f"Added parquet record: {parquet_path}")
         else:
-            logger.error(f"Failed to upload parquet dataset: {parquet_path}")
-        
-        os.remove(temp_parquet)
+            logger.error(f"Failed to upload parquet record: {parquet_path}")
         
     except Exception as e:
         logger.error(f"Error creating parquet entry: {e}", exc_info=True)
 
+def _compact_dataset_day(day: str) -> int:
+    """
+    Склеивает part-файлы дня в один dataset/YYYY-MM-DD.parquet (zstd) и удаляет их.
+    Если склеенный файл уже есть (пришли поздние отзывы), новые записи дописываются к нему.
+    Блокирующая функция — выполняется в storage_executor. Возвращает число склеенных part-файлов.
+    """
+    part_keys = [key for key in yandex_storage.list_files(f"dataset/{day}/") if key.endswith(".parquet")]
+    if not part_keys:
+        return 0
+    
+    day_path = f"dataset/{day}.parquet"
+    tables = []
+    existing = yandex_storage.download_bytes(day_path)
+    if existing:
+        tables.append(pq.read_table(pa.BufferReader(existing)))
+    for key in part_keys:
+        data = yandex_storage.download_bytes(key)
+        if data is None:
+            # Не удаляем ничего, если хотя бы одну запись прочитать не удалось — повторим в следующий раз
+            raise Exception(f"Failed to download {key}")
+        tables.append(pq.read_table(pa.BufferReader(data)))
+    
+    parquet_buffer = io.BytesIO()
+    # Дневные файлы, записанные до PARQUET_RECORD_SCHEMA, могут не содержать части колонок и иметь
+    # выведенные pandas типы: недостающие колонки заполняются null, типы приводятся к общему
+    merged = pa.concat_tables(tables, promote_options="permissive")
+    # Part, который не удалось удалить после прошлой склейки, уже есть в дневном файле — не дублируем записи
+    if "processing_id" in merged.column_names:
+        seen = set()
+        keep = []
+        for index, processing_id in enumerate(merged.column("processing_id").to_pylist()):
+            if not processing_id or processing_id not in seen:
+                seen.add(processing_id)
+                keep.append(index)
+        if len(keep) < merged.num_rows:
+            logger.warning(f"Dataset compaction: dropped {merged.num_rows - len(keep)} duplicate records for {day}")
+            merged = merged.take(keep)
+    pq.write_table(merged, parquet_buffer, compression='zstd')
+    if not yandex_storage.upload_bytes(parquet_buffer.getvalue(), day_path, 'application/octet-stream'):
+        raise Exception(f"Failed to upload {day_path}")
+    
+    failed = [key for key in part_keys if not yandex_storage.delete_file(key)]
+    if failed:
+        # Записи уже в дневном файле; при следующей склейке эти part-файлы отбросятся как дубликаты
+        logger.warning(f"Dataset compaction: {len(failed)} part files for {day} were not deleted")
+    return len(part_keys)
+
+async def compact_dataset_periodically():
+    """Раз в DATASET_COMPACTION_INTERVAL_SECONDS склеивает part-файлы всех прошедших дней."""
+    while True:
+        try:
+            today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+            part_keys = await run_storage(yandex_storage.list_files, "dataset/")
+            days = sorted({key.split("/")[1] for key in part_keys if key.count("/") == 2 and "/part-" in key})
+            for day in days:
+                if day >= today:
+                    continue  # Текущий день еще пополняется
+                compacted = await run_storage(_compact_dataset_day, day)
+                logger.info(f"Dataset compaction: {compacted} records merged into dataset/{day}.parquet")
+        except Exception as e:
+            logger.error(f"Dataset compaction failed: {e}", exc_info=True)
+        await asyncio.sleep(DATASET_COMPACTION_INTERVAL_SECONDS)
+
 
 # --- Основная логика --- 
 
-async def process_specification(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def process_specification(update: Update, context: ContextTypes.DEFAULT_TYPE, status_prefix: str = None):
+    """
+    Полная обработка подтвержденной страницы (OCR, Gemini, отчеты, архив).
+    status_prefix — текст, который нужно показать вместе с первым статусом: если обработка запущена
+    из кнопки подтверждения, оба текста уходят одним редактированием сообщения вместо двух запросов.
+    """
     chat = update.effective_chat
     user_id = update.effective_user.id
+    context.user_data.pop("cancel_requested", None)
     try:
         pdf_bytes = context.user_data["pdf_bytes"]
         page_number = context.user_data.get("manual_page_number") or context.user_data.get("found_page_number")
@@ -1112,62 +1789,79 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
 
 *Определяю структуру таблиц и извлекаю текст*"""
         
-        await chat.send_message(step2_message)
-        pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-        
-        # Проверяем, что страница существует
-        if page_number > len(pdf_document):
-            pdf_document.close()
-            await chat.send_message(f"Ошибка: страница {page_number} не существует. Документ содержит только {len(pdf_document)} страниц.")
-            return
-        
-        page_to_ocr = pdf_document.load_page(page_number - 1)
-        
-        # Начинаем с DPI 300, но уменьшаем если файл слишком большой
-        dpi = 300
+        if status_prefix and update.callback_query:
+            await edit_caption_or_text(update.callback_query, f"{status_prefix}\n\n{step2_message}")
+        else:
+            await chat.send_message(step2_message)
+        # Растеризация и кодирование для OCR — в render_executor
         max_file_size = 4 * 1024 * 1024  # 4MB лимит для Azure
-        
-        while dpi >= 150:
-            pix = page_to_ocr.get_pixmap(dpi=dpi)
-            png_bytes = pix.tobytes("png")
-            
-            if len(png_bytes) <= max_file_size:
-                logger.info(f"[USER_ID: {user_id}] - Using DPI {dpi}, image size: {len(png_bytes) / 1024 / 1024:.1f}MB")
-                break
-            else:
-                logger.warning(f"[USER_ID: {user_id}] - DPI {dpi} too large ({len(png_bytes) / 1024 / 1024:.1f}MB), reducing...")
-                dpi -= 50
+        loop = asyncio.get_running_loop()
+        rendered = await loop.run_in_executor(
+            render_executor, render_page_for_ocr, pdf_bytes, page_number, max_file_size, user_id
+        )
+        if "ocr_bytes" not in rendered:
+            page_count = rendered["page_count"]
+            await chat.send_message(f"Ошибка: страница {page_number} не существует. Документ содержит только {page_count} страниц.")
+            return
+        png_bytes = rendered["ocr_bytes"]
+        ocr_variant = rendered["ocr_variant"]
         
         if len(png_bytes) > max_file_size:
-            pdf_document.close()
             await chat.send_message("Ошибка: страница слишком большая для обработки. Попробуйте с другим документом.")
             return
-            
-        pdf_document.close()
-
-        async with DocumentIntelligenceClient(endpoint=AZURE_ENDPOINT, credential=AzureKeyCredential(AZURE_KEY)) as client:
-            poller = await client.begin_analyze_document("prebuilt-layout", png_bytes, content_type="application/octet-stream")
-            result = await poller.result()
-        if not result.tables:
-            await chat.send_message("Не удалось найти таблицу на указанной странице.")
-            return
-
-        # --- Объединяем ВСЕ найденные таблицы в один HTML для Gemini ---
-        all_tables_html_parts = [table_to_html(table) for table in result.tables]
-        full_html_content = "\n<hr>\n".join(all_tables_html_parts) # Соединяем таблицы линией
-        logger.info(f"[USER_ID: {user_id}] - Combined HTML from {len(result.tables)} tables generated for Gemini.")
+        
+        logger.info(f"[USER_ID: {user_id}] - Using {ocr_variant}, image size: {len(png_bytes) / 1024 / 1024:.1f}MB")
 
-        # --- ОТЛАДКА: Сохраняем этот же HTML в файл ---
-        debug_file_path = os.path.join(TEMP_DIR, f"azure_output_{user_id}.html")
-        with open(debug_file_path, "w", encoding="utf-8") as f:
-            f.write(full_html_content)
-        logger.info(f"[USER_ID: {user_id}] - Azure OCR debug HTML saved to {debug_file_path}")
-        # --- КОНЕЦ ОТЛАДКИ ---
+        # Высококачественная версия для архивирования (тот же растр, что и для OCR) кодируется отдельной
+        # задачей: пока идут Azure и Gemini, она уже будет готова к сохранению
+        archive_image = None
+        if yandex_storage.client:
+            if rendered["ocr_is_full_png"]:
+                archive_image = loop.run_in_executor(render_executor, render_page_for_archive, None, page_number, user_id, png_bytes)
+            else:
+                archive_image = loop.run_in_executor(render_executor, render_page_for_archive, pdf_bytes, page_number, user_id)
+
+        # Повторная загрузка того же PDF (например, после перезапуска бота) берет результат из кэша,
+        # без повторных вызовов Azure и Gemini
+        cache_path = spec_cache_path(context.user_data["pdf_digest"], page_number)
+        # Локальная ссылка больше не нужна (страница уже отрисована, ключ кэша посчитан). Из user_data
+        # PDF убираем только после успешной обработки: при ошибке вроде "таблица не найдена" диалог
+        # остается открытым, и пользователь может ввести другую страницу
+        del pdf_bytes
+        cached = await load_spec_cache(cache_path, user_id)
+        if cached:
+            full_html_content = cached["ocr_html"]
+            full_html_bytes = full_html_content.encode("utf-8")
+            json_data = cached["corrected_json"]
+        else:
+            async with azure_semaphore:
+                poller = await get_azure_client().begin_analyze_document("prebuilt-layout", png_bytes, content_type="application/octet-stream")
+                result = await poller.result()
+            if not result.tables:
+                await chat.send_message("Не удалось найти таблицу на указанной странице.")
+                return
+
+            # --- Объединяем ВСЕ найденные таблицы в один HTML для Gemini ---
+            ocr_text_lines = []  # текст ячеек собирается в том же проходе, что и HTML
+            all_tables_html_parts = [table_to_html(table, ocr_text_lines) for table in result.tables]
+            full_html_content = "\n<hr>\n".join(all_tables_html_parts) # Соединяем таблицы линией
+            logger.info(f"[USER_ID: {user_id}] - Combined HTML from {len(result.tables)} tables generated for Gemini.")
+
+            # Кодируем в UTF-8 один раз: эти же байты уходят в архив и, при fallback, пользователю
+            full_html_bytes = full_html_content.encode("utf-8")
+
+            # --- ОТЛАДКА: Сохраняем этот же HTML в файл ---
+            if SAVE_DEBUG_FILES:
+                await save_debug_file(f"azure_output_{user_id}.html", full_html_bytes, user_id)
+            # --- КОНЕЦ ОТЛАДКИ ---
+
+            if await stop_if_cancelled(context, chat, user_id):
+                return ConversationHandler.END
 
-        # Этап 3: Единая коррекция и извлечение JSON
-        logger.info(f"[USER_ID: {user_id}] - STEP 3: Correcting and extracting JSON with Gemini...")
+            # Этап 3: Единая коррекция и извлечение JSON
+            logger.info(f"[USER_ID: {user_id}] - STEP 3: Correcting and extracting JSON with Gemini...")
         
-        step3_message = """🤖 Этап 3/4: ИИ обработка данных
+            step3_message = """🤖 Этап 3/4: ИИ обработка данных
 
 ✨ Исправляю ошибки OCR с помощью Gemini...
 📊 Структурирую данные в формат JSON...
@@ -1175,19 +1869,26 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
 
 *Это самый сложный этап, может занять 1-2 минуты*"""
         
-        await chat.send_message(step3_message)
+            await chat.send_message(step3_message)
         
-        # Используем fallback стратегию для обработки блокировок
-        json_data = await run_gemini_with_fallback(full_html_content, user_id, chat)
-        logger.info(f"[USER_ID: {user_id}] - JSON extracted successfully.")
+            # Используем fallback стратегию для обработки блокировок
+            json_data = await run_gemini_with_fallback(full_html_content, user_id, chat, ocr_text_lines)
+            logger.info(f"[USER_ID: {user_id}] - JSON extracted successfully.")
+
+            # Результаты fallback-заглушки не кэшируем — при следующей загрузке стоит попробовать снова
+            if FALLBACK_PROFILE_NAME not in (json_data.get("профили") or {}):
+                spawn_background(run_storage(_store_spec_cache, cache_path, full_html_content, json_data), name=f"spec-cache-{user_id}")
 
         # --- ОТЛАДКА: Сохраняем JSON структурированную версию ---
-        json_file_path = os.path.join(TEMP_DIR, f"structured_output_{user_id}.json")
-        with open(json_file_path, "w", encoding="utf-8") as f:
-            json.dump(json_data, f, ensure_ascii=False, indent=2)
-        logger.info(f"[USER_ID: {user_id}] - JSON structured data saved to {json_file_path}")
+        # Сериализуем один раз: эти же байты идут и в отладочный файл, и в архив
+        json_bytes = orjson.dumps(json_data, option=orjson.OPT_NON_STR_KEYS)
+        if SAVE_DEBUG_FILES:
+            await save_debug_file(f"structured_output_{user_id}.json", json_bytes, user_id)
         # --- КОНЕЦ ОТЛАДКИ JSON ---
 
+        if await stop_if_cancelled(context, chat, user_id):
+            return ConversationHandler.END
+
         # Этап 4: Генерация отчетов
         step4_message = """📈 Этап 4/4: Генерация отчетов
 
@@ -1200,10 +1901,10 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
         await chat.send_message(step4_message)
         
         df = flatten_json_to_dataframe(json_data)
-        txt_buffer = io.BytesIO(df.to_string(index=False).encode('utf-8'))
-        xlsx_buffer = io.BytesIO()
-        df.to_excel(xlsx_buffer, index=False, engine='openpyxl')
-        xlsx_buffer.seek(0)
+        # Отчеты строим в report_executor
+        txt_bytes, xlsx_bytes = await asyncio.get_running_loop().run_in_executor(report_executor, render_reports, df)
+        txt_buffer = io.BytesIO(txt_bytes)
+        xlsx_buffer = io.BytesIO(xlsx_bytes)
 
         # Этап 5: Сохранение в Google Cloud Storage для файнтюнинга
         pdf_file_name = context.user_data.get("pdf_file_name", "unknown")
@@ -1213,29 +1914,23 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
         find_prompt = get_prompt("find_and_validate.txt")
         extract_prompt = get_prompt("extract_and_correct.txt")
         
-        # Создаем высококачественную версию для архивирования (DPI 300)
-        pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-        page_for_archive = pdf_document.load_page(page_number - 1)
-        archive_pix = page_for_archive.get_pixmap(dpi=300)  # Всегда высокое качество для архива
-        archive_png_bytes = archive_pix.tobytes("png")
-        pdf_document.close()
-        
-        logger.info(f"[USER_ID: {user_id}] - Archive image: {len(archive_png_bytes) / 1024 / 1024:.1f}MB at 300 DPI")
+        archive_width, archive_height = rendered["size"]
+        logger.info(f"[USER_ID: {user_id}] - Archive image: {archive_width}x{archive_height} at {rendered['dpi']} DPI")
         
         # Сохраняем данные в GCS БЕЗ создания parquet (он будет создан после feedback)
         base_path = await save_to_yandex_initial(
             user_id=user_id,
             pdf_name=pdf_file_name,
-            page_image_bytes=archive_png_bytes,  # Используем архивную версию!
-            ocr_html=full_html_content,
-            corrected_json=json_data,
+            page_image=archive_image,  # Используем архивную версию!
+            ocr_html=full_html_bytes,
+            corrected_json_bytes=json_bytes,
             find_prompt=find_prompt,
             extract_prompt=extract_prompt
         )
         
         # Планируем timeout для обратной связи
         if base_path:
-            schedule_feedback_timeout(user_id, base_path, FEEDBACK_TIMEOUT_SECONDS)
+            schedule_feedback_timeout(user_id, base_path, FEEDBACK_TIMEOUT_SECONDS, json_data)
 
         success_message = """🎉 Обработка завершена успешно!
 
@@ -1257,9 +1952,9 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
         )
         
         # Если использовались fallback стратегии, отправляем дополнительный файл с исходными данными OCR
-        if "Исходные данные OCR" in str(json_data):
+        if FALLBACK_PROFILE_NAME in (json_data.get("профили") or {}):
             try:
-                ocr_buffer = io.BytesIO(full_html_content.encode('utf-8'))
+                ocr_buffer = io.BytesIO(full_html_bytes)
                 await chat.send_document(
                     document=InputFile(ocr_buffer, filename="ocr_raw_data.html"),
                     caption="🔧 **Исходные данные OCR** - для ручной обработки (откройте в браузере)"
@@ -1287,22 +1982,25 @@ async def process_specification(update: Update, context: ContextTypes.DEFAULT_TY
             reply_markup=InlineKeyboardMarkup(feedback_keyboard)
         )
         
-        # Сохраняем контекст для обратной связи (включая base_path)
+        # Дальше PDF не нужен: не держим до 20-50 МБ в user_data все время ожидания обратной связи
+        context.user_data.pop("pdf_bytes", None)
+
+        # Сохраняем контекст для обратной связи — только то, что нужно handle_feedback.
+        # Изображение, OCR HTML и промпты уже в архиве, держать их в памяти до ответа незачем
         context.user_data["processed_files"] = {
             "user_id": user_id,
             "pdf_name": pdf_file_name,
-            "page_image_bytes": archive_png_bytes,
-            "ocr_html": full_html_content,
             "corrected_json": json_data,
-            "find_prompt": find_prompt,
-            "extract_prompt": extract_prompt,
-            "base_path": base_path  # Добавляем путь для финализации
+            "base_path": base_path,  # Добавляем путь для финализации
+            "cache_path": cache_path  # Сбрасывается, если пользователь нашел ошибки
         }
         
         return AWAITING_FEEDBACK
 
     except Exception as e:
         logger.error(f"[USER_ID: {user_id}] - Error in process_specification: {e}", exc_info=True)
+        # Диалог завершается — PDF больше не понадобится
+        context.user_data.pop("pdf_bytes", None)
         await chat.send_message("Произошла непредвиденная ошибка при обработке.")
         return ConversationHandler.END
 
@@ -1325,14 +2023,51 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(welcome_message)
     return SELECTING_ACTION
 
+async def open_pdf_for_analysis(pdf_bytes: bytes, user_id: int):
+    """
+    Общая проверка PDF для документа из Telegram и файла по ссылке.
+    Документ открывается один раз: тот же объект используется для превью найденной страницы.
+    Загрузка в Gemini идет параллельно с проверкой, отклоненный файл удаляется в фоне.
+    Здесь же один раз считается sha256 PDF — ключ кэшей загрузок Gemini, превью и результатов обработки.
+    Возвращает (pdf_document, upload_task, pdf_digest); при отказе бросает ValueError с текстом для пользователя.
+    """
+    too_large = "Файл слишком большой ({} страниц). Пожалуйста, загрузите документ, содержащий не более {} страниц."
+    # Явно слишком большие документы отсекаем по байтам, до полного разбора и загрузки в Gemini
+    # (регулярные выражения по десяткам мегабайт — тоже вне event loop)
+    loop = asyncio.get_running_loop()
+    num_pages, pdf_digest = await asyncio.gather(
+        loop.run_in_executor(cpu_executor, pdf_page_count_hint, pdf_bytes),
+        loop.run_in_executor(cpu_executor, lambda: hashlib.sha256(pdf_bytes).hexdigest()),
+    )
+    if num_pages and num_pages > MAX_PDF_PAGES:
+        logger.warning(f"[USER_ID: {user_id}] - PDF rejected before parsing: too many pages ({num_pages}).")
+        raise ValueError(too_large.format(num_pages, MAX_PDF_PAGES))
+
+    upload_task = start_gemini_upload(pdf_bytes, pdf_digest, user_id)
+    try:
+        pdf_document = await loop.run_in_executor(cpu_executor, open_pdf, pdf_bytes)
+    except Exception as e:
+        spawn_background(discard_gemini_upload(upload_task, user_id))
+        logger.error(f"[USER_ID: {user_id}] - Failed to open PDF: {e}")
+        raise ValueError("Не удалось открыть PDF. Файл может быть поврежден или не является PDF-документом.") from e
+
+    num_pages = len(pdf_document)
+    if num_pages > MAX_PDF_PAGES:
+        pdf_document.close()
+        spawn_background(discard_gemini_upload(upload_task, user_id))
+        logger.warning(f"[USER_ID: {user_id}] - PDF rejected: too many pages ({num_pages}).")
+        raise ValueError(too_large.format(num_pages, MAX_PDF_PAGES))
+    return pdf_document, upload_task, pdf_digest
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    context.user_data.pop("cancel_requested", None)
     
     if not update.message.document:
         return
 
     # --- Проверка размера файла ПЕРЕД скачиванием ---
-    if update.message.document.file_size > 20 * 1024 * 1024: # 20 MB limit
+    if update.message.document.file_size > MAX_TELEGRAM_FILE_SIZE:
         file_size_mb = update.message.document.file_size / 1024 / 1024
         logger.warning(f"[USER_ID: {user_id}] - PDF rejected: file too large ({file_size_mb:.2f} MB).")
         
@@ -1375,16 +2110,13 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         file_url = file_info.file_path
 
-        # Используем httpx для асинхронной потоковой загрузки
-        async with httpx.AsyncClient() as client:
-            async with client.stream("GET", file_url) as response:
-                response.raise_for_status() # Проверяем на ошибки HTTP
-                
-                pdf_bytes_io = io.BytesIO()
-                async for chunk in response.aiter_bytes():
-                    pdf_bytes_io.write(chunk)
-                pdf_bytes_io.seek(0)
-                pdf_bytes = pdf_bytes_io.read()
+        # Используем httpx для асинхронной потоковой загрузки (общий клиент с пулом соединений)
+        async with http_client.stream("GET", file_url) as response:
+            response.raise_for_status() # Проверяем на ошибки HTTP
+            
+            # Читаем сразу в один буфер — без промежуточного BytesIO и второй копии;
+            # лимит проверяем и по ходу чтения, а не только по заявленному file_size
+            pdf_bytes = await read_response_body(response, MAX_TELEGRAM_FILE_SIZE)
 
         context.user_data["pdf_bytes"] = pdf_bytes
         logger.info(f"[USER_ID: {user_id}] - File '{file_name}' downloaded successfully.")
@@ -1398,18 +2130,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Произошла непредвиденная ошибка при скачивании файла.")
         return ConversationHandler.END
 
-    # Проверка на количество страниц
     try:
-        pdf_document_for_check = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-        num_pages = len(pdf_document_for_check)
-        pdf_document_for_check.close()
-        if num_pages > 100:
-            logger.warning(f"[USER_ID: {user_id}] - PDF rejected: too many pages ({num_pages}).")
-            await update.message.reply_text(f"Файл слишком большой ({num_pages} страниц). Пожалуйста, загрузите документ, содержащий не более 100 страниц.")
-            return ConversationHandler.END
-    except Exception as e:
-        logger.error(f"[USER_ID: {user_id}] - Failed to check PDF page count: {e}")
-        await update.message.reply_text("Не удалось проверить количество страниц в PDF. Файл может быть поврежден.")
+        pdf_document, upload_task, context.user_data["pdf_digest"] = await open_pdf_for_analysis(pdf_bytes, user_id)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
         return ConversationHandler.END
 
     analysis_message = """✅ Файл успешно загружен!
@@ -1421,21 +2145,30 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 🤖 ИИ анализирует структуру документа... 
 *Пожалуйста, подождите до 2 минут (большие файлы обрабатываются дольше)*"""
-    
-    await update.message.reply_text(analysis_message)
 
-    temp_pdf_path = None
-    try:
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        temp_pdf_path = os.path.join(TEMP_DIR, f"{user_id}_check.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(pdf_bytes)
+    return await _validate_and_confirm(update, context, pdf_bytes, pdf_document, upload_task, user_id, analysis_message)
 
+async def _validate_and_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, pdf_bytes: bytes, pdf_document: fitz.Document,
+                                upload_task: Optional[asyncio.Task], user_id: int, start_message: str):
+    """
+    Общий шаг 1 для PDF из Telegram и по ссылке: поиск страницы через Gemini и запрос подтверждения.
+    Принимает уже открытый pdf_document (закрывает его по завершении) и задачу загрузки из start_gemini_upload;
+    если до загрузки дело не дошло, она удаляется в фоне. start_message отправляется уже под этой защитой.
+    """
+    preview_task = None
+    upload_consumed = False
+    try:
+        await update.message.reply_text(start_message)
         logger.info(f"[USER_ID: {user_id}] - STEP 1: Performing validation and page search with Gemini.")
         
-        # Создаем задачу для периодического обновления статуса
-        status_task = asyncio.create_task(send_periodic_status_updates(update, user_id, "анализ документа"))
+        # Хэш PDF — ключ кэша превью, посчитан в open_pdf_for_analysis
+        pdf_digest = context.user_data["pdf_digest"]
+        # Рендер превью короткого документа идет параллельно с запросом к Gemini
+        if len(pdf_document) <= SPECULATIVE_PREVIEW_MAX_PAGES:
+            preview_task = asyncio.create_task(prerender_page_previews(pdf_document, pdf_digest, user_id))
         
+        # Таймер обновлений статуса снимается в finally при любом выходе (return, исключение)
+        status_updates = StatusUpdates(update, user_id, "анализ документа")
         try:
             prompt = get_prompt("find_and_validate.txt")
             model = create_gemini_model()
@@ -1443,9 +2176,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if USE_VERTEX_AI:
                 try:
                     from vertexai.generative_models import Part as VPart
-                    with open(temp_pdf_path, 'rb') as f:
-                        pdf_data = f.read()
-                    file_part = VPart.from_data(pdf_data, mime_type="application/pdf")
+                    file_part = VPart.from_data(pdf_bytes, mime_type="application/pdf")
                     response = await run_gemini_with_retry(
                         model,
                         prompt,
@@ -1458,15 +2189,15 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("Vertex AI недоступен. Проверьте переменные окружения и зависимости.")
                     return ConversationHandler.END
             else:
-                gemini_file = genai.upload_file(path=temp_pdf_path)
-                # Ждем пока файл перейдет в состояние ACTIVE, чтобы избежать 500 Internal errors
+                # Загрузка из памяти и ожидание ACTIVE были запущены параллельно с проверкой PDF
+                upload_consumed = True
                 try:
-                    gemini_file = await wait_for_gemini_file_active(gemini_file, user_id)
+                    gemini_file = await upload_task
                 except Exception as wait_err:
                     logger.error(f"[USER_ID: {user_id}] - Gemini file not ready: {wait_err}")
                     await update.message.reply_text("Сервис анализа временно недоступен. Попробуйте еще раз через минуту.")
                     return ConversationHandler.END
-                
+            
                 response = await run_gemini_with_retry(
                     model,
                     prompt,
@@ -1474,7 +2205,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     user_id,
                     generation_config=GenerationConfig(response_mime_type="application/json")
                 )
-                genai.delete_file(gemini_file.name)
+                # Файл не удаляем: он остается в кэше загрузок для повторной отправки того же PDF,
+                # истекшие файлы удаляет sweep_gemini_files_periodically
 
             try:
                 result = parse_gemini_json(response, user_id, debug_tag="find_validate")
@@ -1483,12 +2215,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("Не удалось распознать ответ от сервиса анализа. Попробуйте другой файл.")
                 return ConversationHandler.END
         finally:
-            # Отменяем задачу обновления статуса
-            status_task.cancel()
-            try:
-                await status_task
-            except asyncio.CancelledError:
-                pass
+            status_updates.cancel()
+
+        if await stop_if_cancelled(context, update.effective_chat, user_id):
+            return ConversationHandler.END
 
         page_number = result.get("page", 0)
         if page_number == 0:
@@ -1496,48 +2226,56 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return AWAITING_MANUAL_PAGE
 
         context.user_data["found_page_number"] = page_number
-        pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-        page = pdf_document.load_page(page_number - 1)
         
-        # Подготавливаем изображение для Telegram
-        img_buffer = prepare_telegram_image(page, user_id)
-        pdf_document.close()
+        # Подготавливаем изображение для Telegram (рендер вне event loop, повторы — из кэша)
+        if preview_task is not None:
+            await asyncio.gather(preview_task, return_exceptions=True)
+        img_buffer = await get_page_preview(pdf_document, pdf_digest, page_number, user_id)
 
         keyboard = [[InlineKeyboardButton("✅ Да", callback_data="yes"), InlineKeyboardButton("❌ Нет", callback_data="no")]]
         
+        question = f"Это верная таблица (страница {page_number})?"
         try:
             await update.message.reply_photo(
                 photo=img_buffer,
-                caption=f"Это верная таблица (страница {page_number})?",
+                caption=question,
                 reply_markup=InlineKeyboardMarkup(keyboard),
             )
         except telegram.error.BadRequest as e:
-            if "Photo_invalid_dimensions" in str(e):
-                # Если не удалось отправить изображение, отправляем текстовое сообщение
-                logger.warning(f"[USER_ID: {user_id}] - Failed to send photo, sending text message instead: {e}")
-                await update.message.reply_text(
-                    f"Найдена страница {page_number}. Это верная таблица?",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            else:
-                raise e
+            # Telegram не принял превью — не теряем найденную страницу, спрашиваем текстом
+            logger.warning(f"[USER_ID: {user_id}] - Preview photo rejected, falling back to text: {e}")
+            await update.message.reply_text(question, reply_markup=InlineKeyboardMarkup(keyboard))
                 
         return AWAITING_CONFIRMATION
 
     except Exception as e:
-        logger.error(f"[USER_ID: {user_id}] - Error in handle_document: {e}", exc_info=True)
+        logger.error(f"[USER_ID: {user_id}] - Error in _validate_and_confirm: {e}", exc_info=True)
         await update.message.reply_text("Ошибка при анализе документа.")
         return ConversationHandler.END
     finally:
-        if temp_pdf_path and os.path.exists(temp_pdf_path):
-            os.remove(temp_pdf_path)
+        # Документ закрываем только после фонового рендера, который еще может его читать
+        if preview_task is not None:
+            await asyncio.gather(preview_task, return_exceptions=True)
+        pdf_document.close()
+        # Выход до шага с Gemini: загрузка никому не нужна, но задача еще идет — не бросаем ее
+        if not upload_consumed:
+            spawn_background(discard_gemini_upload(upload_task, user_id), name=f"discard-upload-{user_id}")
+
+async def edit_caption_or_text(query, text: str, reply_markup=None):
+    """
+    Редактирует сообщение с кнопками: у фото меняется подпись, у текстового сообщения — текст.
+    Тип сообщения проверяется заранее, без перехвата BadRequest.
+    """
+    if query.message.text is None:
+        await query.edit_message_caption(caption=text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
 
 async def handle_confirmation_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     if query.data == "yes":
-        # Пробуем отредактировать caption, если не получается - отправляем новое сообщение
         processing_message = """🎯 Отлично! Страница подтверждена!
 
 🚀 Начинаю полную обработку:
@@ -1550,26 +2288,10 @@ async def handle_confirmation_choice(update: Update, context: ContextTypes.DEFAU
 ⏰ Время обработки: 1-3 минуты
 *Пожалуйста, ожидайте...*"""
 
-        try:
-            await query.edit_message_caption(caption=processing_message)
-        except telegram.error.BadRequest as e:
-            if "There is no caption in the message to edit" in str(e):
-                logger.info(f"No caption to edit, using edit_message_text instead: {e}")
-                await query.edit_message_text(text=processing_message)
-            else:
-                raise e
-        
-        return await process_specification(update, context)
+        # Сообщение о старте и статус этапа 2 отправляются одним редактированием
+        return await process_specification(update, context, status_prefix=processing_message)
     else:
-        # Пробуем отредактировать caption, если не получается - отправляем новое сообщение
-        try:
-            await query.edit_message_caption(caption="Введите правильный номер страницы:")
-        except telegram.error.BadRequest as e:
-            if "There is no caption in the message to edit" in str(e):
-                logger.info(f"No caption to edit, using edit_message_text instead: {e}")
-                await query.edit_message_text(text="Введите правильный номер страницы:")
-            else:
-                raise e
+        await edit_caption_or_text(query, "Введите правильный номер страницы:")
         
         return AWAITING_MANUAL_PAGE
 
@@ -1589,26 +2311,17 @@ async def handle_file_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     user_id = update.effective_user.id
     url = update.message.text.strip()
+    context.user_data.pop("cancel_requested", None)
     
-    # Извлекаем имя файла из URL для Dropbox
-    file_name_from_url = "unknown"
-    try:
-        # Для Dropbox ссылок пытаемся извлечь имя файла из пути
-        import urllib.parse
-        parsed_url = urllib.parse.urlparse(url)
-        path_parts = parsed_url.path.split('/')
-        for part in path_parts:
-            if part.endswith('.pdf'):
-                file_name_from_url = part
-                break
-    except:
-        file_name_from_url = "dropbox_file.pdf"
+    # Извлекаем имя файла из URL для Dropbox (последний сегмент пути)
+    name = posixpath.basename(urlparse(url).path)
+    file_name_from_url = name if name.lower().endswith('.pdf') else "dropbox_file.pdf"
     
     # Сохраняем имя файла для использования в GCS
     context.user_data["pdf_file_name"] = file_name_from_url
     
     # Проверяем валидность ссылки
-    if not is_valid_file_url(url):
+    if not url.startswith(DROPBOX_URL_PREFIXES):
         supported_services = """❌ Поддерживается только Dropbox
 
 🔗 Загрузите файл на Dropbox:
@@ -1625,102 +2338,19 @@ async def handle_file_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pdf_bytes = await download_file_from_url(url, user_id)
         logger.info(f"[USER_ID: {user_id}] - File downloaded from URL: {len(pdf_bytes)} bytes")
         
-        # Проверяем, что это PDF
         try:
-            pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-            num_pages = len(pdf_document)
-            pdf_document.close()
-        except Exception:
-            await update.message.reply_text("❌ Файл не является корректным PDF-документом.")
-            return AWAITING_URL
-        
-        # Проверяем количество страниц
-        if num_pages > 100:
-            await update.message.reply_text(f"❌ Документ слишком большой ({num_pages} страниц). Максимум 100 страниц.")
+            pdf_document, upload_task, context.user_data["pdf_digest"] = await open_pdf_for_analysis(pdf_bytes, user_id)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
             return AWAITING_URL
+        num_pages = len(pdf_document)
         
         # Сохраняем данные и продолжаем обработку
         context.user_data["pdf_bytes"] = pdf_bytes
-        await update.message.reply_text(f"✅ Файл успешно загружен! Документ содержит {num_pages} страниц. Начинаю анализ...")
-        
-        # Продолжаем обработку как обычно
-        temp_pdf_path = None
-        try:
-            os.makedirs(TEMP_DIR, exist_ok=True)
-            temp_pdf_path = os.path.join(TEMP_DIR, f"{user_id}_check.pdf")
-            with open(temp_pdf_path, "wb") as f:
-                f.write(pdf_bytes)
-
-            logger.info(f"[USER_ID: {user_id}] - STEP 1: Performing validation and page search with Gemini.")
-            gemini_file = genai.upload_file(path=temp_pdf_path)
-            # Ждем активного состояния файла перед вызовом модели
-            try:
-                gemini_file = await wait_for_gemini_file_active(gemini_file, user_id)
-            except Exception as wait_err:
-                logger.error(f"[USER_ID: {user_id}] - Gemini file not ready: {wait_err}")
-                await update.message.reply_text("Сервис анализа временно недоступен. Попробуйте еще раз через минуту.")
-                return ConversationHandler.END
-            prompt = get_prompt("find_and_validate.txt")
-            model = create_gemini_model()
-            
-            response = await run_gemini_with_retry(
-                model,
-                prompt,
-                gemini_file,
-                user_id,
-                generation_config=GenerationConfig(response_mime_type="application/json")
-            )
-            genai.delete_file(gemini_file.name)
-
-            try:
-                cleaned_text = response.text.replace("```json", "").replace("```", "").strip()
-                result = json.loads(cleaned_text)
-            except (json.JSONDecodeError, AttributeError, ValueError) as e:
-                logger.error(f"[USER_ID: {user_id}] - Failed to decode Gemini response: {e}", exc_info=True)
-                await update.message.reply_text("Не удалось распознать ответ от сервиса анализа. Попробуйте другой файл.")
-                return ConversationHandler.END
-
-            page_number = result.get("page", 0)
-            if page_number == 0:
-                await update.message.reply_text("Не удалось найти страницу. Введите номер вручную.")
-                return AWAITING_MANUAL_PAGE
-
-            context.user_data["found_page_number"] = page_number
-            pdf_document = fitz.open(stream=io.BytesIO(pdf_bytes), filetype="pdf")
-            page = pdf_document.load_page(page_number - 1)
-            
-            # Подготавливаем изображение для Telegram
-            img_buffer = prepare_telegram_image(page, user_id)
-            pdf_document.close()
-
-            keyboard = [[InlineKeyboardButton("✅ Да", callback_data="yes"), InlineKeyboardButton("❌ Нет", callback_data="no")]]
-            
-            try:
-                await update.message.reply_photo(
-                    photo=img_buffer,
-                    caption=f"Это верная таблица (страница {page_number})?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                )
-            except telegram.error.BadRequest as e:
-                if "Photo_invalid_dimensions" in str(e):
-                    # Если не удалось отправить изображение, отправляем текстовое сообщение
-                    logger.warning(f"[USER_ID: {user_id}] - Failed to send photo, sending text message instead: {e}")
-                    await update.message.reply_text(
-                        f"Найдена страница {page_number}. Это верная таблица?",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                else:
-                    raise e
-                    
-            return AWAITING_CONFIRMATION
-
-        except Exception as e:
-            logger.error(f"[USER_ID: {user_id}] - Error in handle_file_url: {e}", exc_info=True)
-            await update.message.reply_text("Ошибка при анализе документа.")
-            return ConversationHandler.END
-        finally:
-            if temp_pdf_path and os.path.exists(temp_pdf_path):
-                os.remove(temp_pdf_path)
+        return await _validate_and_confirm(
+            update, context, pdf_bytes, pdf_document, upload_task, user_id,
+            f"✅ Файл успешно загружен! Документ содержит {num_pages} страниц. Начинаю анализ...",
+        )
         
     except ValueError as e:
         # Ошибки размера файла
@@ -1747,16 +2377,15 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Отменяем timeout задачу
     if user_id in pending_feedback_tasks:
-        pending_feedback_tasks[user_id]["cancel"] = True
-        pending_feedback_tasks.pop(user_id, None)
+        pending_feedback_tasks.pop(user_id).handle.cancel()
         logger.info(f"[USER_ID: {user_id}] - Feedback timeout cancelled (user responded)")
     
     if query.data == "feedback_yes":
         # Пользователь доволен результатом
         await query.edit_message_text("✅ Спасибо за положительную оценку! Ваш отзыв поможет нам улучшать сервис.")
         
-        # Финализируем GCS запись с положительной обратной связью
-        await finalize_yandex_entry(base_path, "good")
+        # Финализируем запись с положительной обратной связью в фоне — ответ пользователю уже отправлен
+        spawn_background(finalize_yandex_entry(base_path, "good", processed_files.get("corrected_json")), name=f"finalize-{user_id}")
         
         context.user_data.clear()
         return ConversationHandler.END
@@ -1787,8 +2416,12 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(admin_keyboard)
         )
         
-        # Финализируем GCS запись с отрицательной обратной связью
-        await finalize_yandex_entry(base_path, "bad")
+        # Финализируем запись с отрицательной обратной связью в фоне
+        spawn_background(finalize_yandex_entry(base_path, "bad", processed_files.get("corrected_json")), name=f"finalize-{user_id}")
+        # Ошибочный результат не должен отдаваться из кэша при повторной загрузке
+        cache_path = processed_files.get("cache_path")
+        if cache_path:
+            spawn_background(run_storage(yandex_storage.delete_file, cache_path), name=f"spec-cache-drop-{user_id}")
         
         context.user_data.clear()
         return ConversationHandler.END
@@ -1798,6 +2431,30 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
+async def cancel_while_processing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /cancel, пока идет неблокирующая обработка (состояние WAITING): обработка сама остановится
+    на ближайшей границе этапов (см. stop_if_cancelled) и завершит диалог.
+    """
+    context.user_data["cancel_requested"] = True
+    await update.message.reply_text("🛑 Отменяю обработку — остановлюсь после текущего этапа.")
+
+async def reply_while_processing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отвечает на сообщения и нажатия кнопок, пришедшие во время обработки, вместо того чтобы молча их терять"""
+    if update.callback_query:
+        await update.callback_query.answer(PROCESSING_IN_PROGRESS_MESSAGE)
+    elif update.effective_message:
+        await update.effective_message.reply_text(PROCESSING_IN_PROGRESS_MESSAGE)
+
+async def stop_if_cancelled(context: ContextTypes.DEFAULT_TYPE, chat, user_id: int) -> bool:
+    """Проверяет, просил ли пользователь /cancel во время обработки; если да — сбрасывает сессию"""
+    if not context.user_data.get("cancel_requested"):
+        return False
+    logger.info(f"[USER_ID: {user_id}] - Processing cancelled by user")
+    context.user_data.clear()
+    await chat.send_message("Действие отменено.")
+    return True
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает ошибки бота"""
     logger.error(f"Exception while handling an update: {context.error}", exc_info=context.error)
@@ -1821,6 +2478,43 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         except Exception:
             pass
 
+async def on_startup(app: Application):
+    """Запускает фоновые задачи бота"""
+    if yandex_storage.client:
+        app.bot_data["dataset_compaction_task"] = spawn_background(compact_dataset_periodically(), name="dataset-compaction")
+    if not USE_VERTEX_AI:
+        app.bot_data["gemini_file_sweep_task"] = spawn_background(sweep_gemini_files_periodically(), name="gemini-file-sweep")
+
+async def on_shutdown(app: Application):
+    """Закрывает общие клиенты и пулы при остановке бота"""
+    compaction_task = app.bot_data.get("dataset_compaction_task")
+    if compaction_task:
+        compaction_task.cancel()
+    sweep_task = app.bot_data.get("gemini_file_sweep_task")
+    if sweep_task:
+        sweep_task.cancel()
+    # Таймеры обратной связи живут только в этом event loop: закрываем ожидающие записи как timeout,
+    # чтобы они не потерялись при перезапуске
+    if pending_feedback_tasks:
+        pending = list(pending_feedback_tasks.values())
+        pending_feedback_tasks.clear()
+        for entry in pending:
+            entry.handle.cancel()
+        await asyncio.gather(*(finalize_yandex_entry(entry.base_path, "timeout", entry.corrected_data) for entry in pending), return_exceptions=True)
+    # Фоновые задачи (финализация отзывов, загрузки в архив) дописываем до закрытия клиентов и пулов,
+    # иначе отзыв, отправленный прямо перед перезапуском, теряется
+    if background_tasks:
+        _, still_running = await asyncio.wait(set(background_tasks), timeout=SHUTDOWN_BACKGROUND_TIMEOUT_SECONDS)
+        if still_running:
+            logger.warning(f"Shutdown: {len(still_running)} background tasks did not finish in time")
+    await http_client.aclose()
+    if get_azure_client.cache_info().currsize:
+        await get_azure_client().close()
+    storage_executor.shutdown(wait=False)
+    cpu_executor.shutdown(wait=False)
+    report_executor.shutdown(wait=False)
+    render_executor.shutdown(wait=False)
+
 def main():
     # Проверяем обязательные переменные в зависимости от режима
     missing = []
@@ -1846,30 +2540,54 @@ def main():
     if not GCS_BUCKET:
         logger.warning("GCS_BUCKET not configured - archiving will be disabled")
 
-    # Останавливаем все существующие webhook'и для предотвращения конфликтов
-    try:
-        import requests
-        response = requests.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/deleteWebhook")
-        logger.info("Webhook deleted to prevent conflicts")
-    except Exception as e:
-        logger.warning(f"Could not delete webhook: {e}")
-
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Каталог для отладочных файлов: в репозитории его нет, а создает его только Dockerfile
+    os.makedirs(TEMP_DIR, exist_ok=True)
+
+    # Модель создается один раз при старте; обработчики получают ее же из кэша create_gemini_model
+    create_gemini_model()
+
+    # Отдельный deleteWebhook не нужен: run_polling сам снимает webhook при старте,
+    # а run_webhook перезаписывает его через setWebhook (оба с drop_pending_updates=True)
+    # в том же event loop и через тот же пул соединений бота.
+
+    # Общий пул keep-alive соединений (HTTP/2) к Bot API для всех пользователей.
+    # getUpdates держит long-poll запрос, поэтому у него отдельный небольшой пул.
+    bot_request = HTTPXRequest(connection_pool_size=64, http_version="2", pool_timeout=10.0)
+    updates_request = HTTPXRequest(connection_pool_size=1, http_version="2")
+
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(bot_request)
+        .get_updates_request(updates_request)
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Добавляем обработчик ошибок
     app.add_error_handler(error_handler)
     
+    # Долгие обработчики (скачивание, Gemini, рендер, OCR) не блокируют диспетчер:
+    # пока один пользователь ждет, обновления остальных обрабатываются параллельно
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             SELECTING_ACTION: [
-                MessageHandler(filters.Document.PDF, handle_document),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_file_url)
+                MessageHandler(filters.Document.PDF, handle_document, block=False),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_file_url, block=False)
             ],
-            AWAITING_CONFIRMATION: [CallbackQueryHandler(handle_confirmation_choice)],
-            AWAITING_MANUAL_PAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_page_input)],
-            AWAITING_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_file_url)],
+            AWAITING_CONFIRMATION: [CallbackQueryHandler(handle_confirmation_choice, block=False)],
+            AWAITING_MANUAL_PAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_page_input, block=False)],
+            AWAITING_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_file_url, block=False)],
             AWAITING_FEEDBACK: [CallbackQueryHandler(handle_feedback)],
+            # Пока неблокирующий обработчик не вернул новое состояние, обновления попадают сюда
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cancel_while_processing),
+                MessageHandler(filters.ALL, reply_while_processing),
+                CallbackQueryHandler(reply_while_processing),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_message=False,  # Возвращаем обратно для работы команд
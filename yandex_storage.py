@@ -5,7 +5,8 @@ import os
 import boto3
 from botocore.config import Config
 import gzip
-import json
+import zstandard
+import orjson
 from datetime import datetime
 from typing import Optional, Dict, Any
 import logging
@@ -39,16 +40,27 @@ class YandexStorageClient:
         
         logger.info(f"Yandex Object Storage client initialized for bucket: {self.bucket_name} (region={self.region})")
     
-    def upload_file(self, local_path: str, remote_path: str, content_type: str = None) -> bool:
+    @staticmethod
+    def _object_args(content_type: str = None, metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> Dict[str, Any]:
+        """Собирает заголовки объекта: метаданные уходят тем же PUT запросом, без отдельного вызова"""
+        args = {}
+        if content_type:
+            args['ContentType'] = content_type
+        if metadata:
+            args['Metadata'] = metadata
+        if cache_control:
+            args['CacheControl'] = cache_control
+        return args
+    
+    def upload_file(self, local_path: str, remote_path: str, content_type: str = None,
+                    metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
         """Загружает файл в Yandex Object Storage"""
         if not self.client:
             logger.warning("Yandex Storage client not initialized")
             return False
             
         try:
-            extra_args = {}
-            if content_type:
-                extra_args['ContentType'] = content_type
+            extra_args = self._object_args(content_type, metadata, cache_control)
                 
             self.client.upload_file(
                 local_path, 
@@ -64,51 +76,62 @@ class YandexStorageClient:
             logger.error(f"Failed to upload to Yandex Storage: {e}")
             return False
     
-    def upload_string(self, content: str, remote_path: str, content_type: str = "text/plain") -> bool:
-        """Загружает строку как файл в Yandex Object Storage"""
+    def upload_bytes(self, data: bytes, remote_path: str, content_type: str = "application/octet-stream",
+                     metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
+        """Загружает байты из памяти в Yandex Object Storage (без временного файла на диске)"""
         if not self.client:
-            logger.warning("Yandex Storage client not initialized") 
+            logger.warning("Yandex Storage client not initialized")
             return False
             
         try:
             self.client.put_object(
                 Bucket=self.bucket_name,
                 Key=remote_path,
-                Body=content.encode('utf-8'),
-                ContentType=content_type
+                Body=data,
+                **self._object_args(content_type, metadata, cache_control)
             )
             
-            logger.info(f"Successfully uploaded string content -> {remote_path}")
+            logger.info(f"Successfully uploaded {len(data)} bytes -> {remote_path}")
             return True
             
         except Exception as e:
-            logger.error(f"Failed to upload string to Yandex Storage: {e}")
+            logger.error(f"Failed to upload bytes to Yandex Storage: {e}")
             return False
     
-    def upload_json(self, data: Dict[Any, Any], remote_path: str) -> bool:
+    def upload_string(self, content, remote_path: str, content_type: str = "text/plain",
+                      metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
+        """Загружает строку (или уже закодированные UTF-8 байты) как файл в Yandex Object Storage"""
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        return self.upload_bytes(data, remote_path, content_type, metadata, cache_control)
+    
+    def upload_json(self, data: Dict[Any, Any], remote_path: str,
+                    metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
         """Загружает JSON данные в Yandex Object Storage"""
         try:
-            json_content = json.dumps(data, ensure_ascii=False, indent=2)
-            return self.upload_string(json_content, remote_path, "application/json")
+            # orjson сразу отдает UTF-8 байты (кириллица без экранирования)
+            json_content = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+            return self.upload_string(json_content, remote_path, "application/json", metadata, cache_control)
         except Exception as e:
             logger.error(f"Failed to serialize JSON for upload: {e}")
             return False
     
-    def upload_gzipped_string(self, content: str, remote_path: str, content_type: str = "text/plain") -> bool:
-        """Загружает gzip-сжатую строку в Yandex Object Storage"""
+    def upload_gzipped_string(self, content, remote_path: str, content_type: str = "text/plain", compresslevel: int = 9,
+                              metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
+        """Загружает gzip-сжатую строку (или уже закодированные UTF-8 байты) в Yandex Object Storage"""
         if not self.client:
             logger.warning("Yandex Storage client not initialized")
             return False
             
         try:
-            compressed = gzip.compress(content.encode('utf-8'))
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            compressed = gzip.compress(data, compresslevel=compresslevel)
             
             self.client.put_object(
                 Bucket=self.bucket_name,
                 Key=remote_path,
                 Body=compressed,
-                ContentType=content_type,
-                ContentEncoding='gzip'
+                ContentEncoding='gzip',
+                **self._object_args(content_type, metadata, cache_control)
             )
             
             logger.info(f"Successfully uploaded gzipped content -> {remote_path}")
@@ -118,6 +141,58 @@ class YandexStorageClient:
             logger.error(f"Failed to upload gzipped content to Yandex Storage: {e}")
             return False
     
+    def upload_zstd_string(self, content, remote_path: str, content_type: str = "text/plain", level: int = 3,
+                           metadata: Optional[Dict[str, str]] = None, cache_control: str = None) -> bool:
+        """Загружает zstd-сжатую строку (или UTF-8 байты) в Yandex Object Storage"""
+        if not self.client:
+            logger.warning("Yandex Storage client not initialized")
+            return False
+            
+        try:
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            compressed = zstandard.ZstdCompressor(level=level).compress(data)
+            
+            self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=remote_path,
+                Body=compressed,
+                ContentEncoding='zstd',
+                **self._object_args(content_type, metadata, cache_control)
+            )
+            
+            logger.info(f"Successfully uploaded zstd content -> {remote_path}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to upload zstd content to Yandex Storage: {e}")
+            return False
+    
+    def update_metadata(self, remote_path: str, metadata: Dict[str, str], content_type: str = None, cache_control: str = None) -> bool:
+        """Заменяет пользовательские метаданные объекта без перезаливки его содержимого.
+
+        В S3 это copy_object объекта самого в себя с MetadataDirective=REPLACE — копирование выполняется
+        на стороне сервера, тело объекта не передается.
+        """
+        if not self.client:
+            logger.warning("Yandex Storage client not initialized")
+            return False
+            
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket_name,
+                Key=remote_path,
+                CopySource={'Bucket': self.bucket_name, 'Key': remote_path},
+                MetadataDirective='REPLACE',
+                **self._object_args(content_type, metadata, cache_control)
+            )
+            
+            logger.info(f"Successfully updated metadata -> {remote_path}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to update metadata in Yandex Storage: {e}")
+            return False
+    
     def download_file(self, remote_path: str, local_path: str) -> bool:
         """Скачивает файл из Yandex Object Storage"""
         if not self.client:
@@ -133,6 +208,40 @@ class YandexStorageClient:
             logger.error(f"Failed to download from Yandex Storage: {e}")
             return False
     
+    def download_bytes(self, remote_path: str) -> Optional[bytes]:
+        """Скачивает файл из Yandex Object Storage в память"""
+        if not self.client:
+            logger.warning("Yandex Storage client not initialized")
+            return None
+            
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=remote_path)
+            data = response['Body'].read()
+            logger.info(f"Successfully downloaded {remote_path} ({len(data)} bytes)")
+            return data
+            
+        except self.client.exceptions.NoSuchKey:
+            logger.info(f"Object not found in Yandex Storage: {remote_path}")
+            return None
+        except Exception as e:
+            logger.error(f"Failed to download from Yandex Storage: {e}")
+            return None
+    
+    def delete_file(self, remote_path: str) -> bool:
+        """Удаляет файл из Yandex Object Storage"""
+        if not self.client:
+            logger.warning("Yandex Storage client not initialized")
+            return False
+            
+        try:
+            self.client.delete_object(Bucket=self.bucket_name, Key=remote_path)
+            logger.info(f"Successfully deleted {remote_path}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to delete from Yandex Storage: {e}")
+            return False
+    
     def file_exists(self, remote_path: str) -> bool:
         """Проверяет существование файла в Yandex Object Storage"""
         if not self.client:
@@ -150,14 +259,11 @@ class YandexStorageClient:
             return []
             
         try:
-            response = self.client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
+            # list_objects_v2 отдает не больше 1000 ключей за запрос — проходим все страницы
+            paginator = self.client.get_paginator('list_objects_v2')
             files = []
-            if 'Contents' in response:
-                files = [obj['Key'] for obj in response['Contents']]
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                files.extend(obj['Key'] for obj in page.get('Contents', []))
             
             return files
             
@@ -169,6 +275,9 @@ class YandexStorageClient:
 yandex_storage = YandexStorageClient()
 
 def reinitialize_global_client():
-    """Переинициализирует глобальный клиент с текущими переменными окружения."""
-    global yandex_storage
-    yandex_storage = YandexStorageClient()
+    """Переинициализирует глобальный клиент с текущими переменными окружения.
+
+    Экземпляр обновляется на месте: модули, уже сделавшие `from yandex_storage import yandex_storage`,
+    продолжают работать с тем же (единственным) клиентом и его пулом соединений.
+    """
+    yandex_storage.__init__()